@@ -0,0 +1,78 @@
+"""
+Compare document conversion time of the fast paths against MarkItDown per content type.
+
+Run from the repository root:
+    python -m benchmarks.convert_benchmark [--repeat 20] [--file path:mimetype ...]
+"""
+import argparse
+import json
+import statistics
+import time
+
+from classs.DocumentConverter import fast_convert, _convert
+
+
+def sample_documents() -> dict:
+    paragraph = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor. " * 6
+    text = "\n\n".join(paragraph for _ in range(200))
+    data = {
+        "items": [
+            {"id": i, "name": f"item {i}", "tags": ["a", "b", "c"], "description": paragraph}
+            for i in range(300)
+        ]
+    }
+    sections = "".join(
+        f"<h2>Section {i}</h2><p>{paragraph} <a href='https://example.com/{i}'>link</a> <b>bold</b></p>"
+        f"<ul><li>first</li><li>second</li></ul>"
+        for i in range(100)
+    )
+    html = (
+        "<html><head><title>Benchmark</title><style>body{margin:0}</style><script>var x = 1;</script></head>"
+        "<body><nav><a href='/'>Home</a><a href='/about'>About</a></nav>"
+        f"<main><h1>Benchmark page</h1>{sections}"
+        "<table><tr><th>Name</th><th>Value</th></tr>"
+        + "".join(f"<tr><td>row {i}</td><td>{i * 3}</td></tr>" for i in range(50)) +
+        "</table></main><footer>Footer</footer></body></html>"
+    )
+    return {
+        "text/plain": text.encode("utf8"),
+        "application/json": json.dumps(data).encode("utf8"),
+        "text/html": html.encode("utf8"),
+    }
+
+
+def measure(function, source: bytes, mimetype: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(source, mimetype, "utf-8")
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--file", action="append", default=[], help="Extra document as path:mimetype")
+    args = parser.parse_args()
+
+    documents = sample_documents()
+    for entry in args.file:
+        path, _, mimetype = entry.rpartition(":")
+        with open(path, "rb") as file:
+            documents[f"{mimetype} ({path})"] = file.read()
+
+    _convert(b"warm up", "text/plain", "utf-8")
+    print(f"{'content type':<40} {'size':>10} {'fast ms':>10} {'markitdown ms':>14} {'speedup':>8}")
+    for name, source in documents.items():
+        mimetype = name.split(" ")[0]
+        slow = measure(_convert, source, mimetype, args.repeat)
+        if fast_convert(source, mimetype, "utf-8") is None:
+            print(f"{name:<40} {len(source):>10} {'-':>10} {slow:>14.2f} {'-':>8}")
+            continue
+        fast = measure(fast_convert, source, mimetype, args.repeat)
+        print(f"{name:<40} {len(source):>10} {fast:>10.2f} {slow:>14.2f} {slow / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import io
 import mimetypes
@@ -10,6 +11,9 @@ import discord
 from discord import Message, Embed, Member, User
 from classs import FClient
 
+# Discord caps the text of all components in a message at 4000 characters, keep room for the typing line
+PROGRESS_TEXT_LIMIT = 3900
+
 
 class AIContext:
     message: Message
@@ -19,15 +23,18 @@ class AIContext:
     _response: str
     _response_message: Message
     _last_edit: float
+    _edit_task: asyncio.Task | None
 
     def __init__(self, message: Message, client: FClient):
         self.message = message
         self.author = message.author
         self.client = client
         self.voice_client = message.guild.voice_client
-        self.mcp_session = client.mcp_manager.create_session()
         self._response = ""
         self._last_edit = 0
+        self._edit_task = None
+        self._stream_parser = None
+        self._edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
         self.attachments = []
         self.cache_attachments = []
         self.embeds = []
@@ -36,10 +43,12 @@ class AIContext:
         self.attachments_update = False
         self.embeds_update = False
         self.message_file = None
+        self.tool_outputs = {}
+        self.steps = []  # Timing and usage of every agent loop step
+        self.budget_exhausted = None  # Name of the budget that ended the agent loop early
 
     async def __aenter__(self):
         await self.start_response()
-        await self.mcp_session.__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -57,7 +66,6 @@ class AIContext:
             await self._response_message.edit(view=view)
             print(f"Error in AIContext: {error_message}")
             print("Error Response:", self._response, "-------- error end --------")
-        await self.mcp_session.__aexit__(exc_type, exc_val, exc_tb)
 
     def _gen_kwargs(self):
         kwargs = {}
@@ -84,6 +92,12 @@ class AIContext:
                 return attachment.filename
         return None
 
+    def store_tool_output(self, name: str, content: str) -> str:
+        """Keep a tool output that was too long for the conversation, returns its id."""
+        output_id = f"{name}-{len(self.tool_outputs) + 1}"
+        self.tool_outputs[output_id] = content
+        return output_id
+
     def add_attachment(self, attachment: discord.File):
         self.attachments.append(attachment)
         self.attachments_update = True
@@ -91,6 +105,63 @@ class AIContext:
     def add_response(self, response: str):
         self._response += response
 
+    def rollback_response(self, length: int):
+        """Drop response text added after `length`, e.g. a step that timed out mid stream."""
+        if len(self._response) <= length:
+            return
+        self._response = self._response[:length]
+        self._stream_parser = None
+        if self._response:
+            self._stream_parser = self.client.format_messages.create_stream_parser()
+            self._stream_parser.feed(self._response)
+
+    def stream_response(self, delta: str):
+        """
+        Add a streamed delta and schedule a progressive edit of the reply.
+        Edits are coalesced so at most one is sent per STREAM_EDIT_INTERVAL seconds.
+        """
+        self.add_response(delta)
+        if self._stream_parser is None:
+            self._stream_parser = self.client.format_messages.create_stream_parser()
+        self._stream_parser.feed(delta)
+        if self._edit_task is not None and not self._edit_task.done():
+            return  # pending edit will pick up the latest text
+        delay = max(0.0, self._last_edit + self._edit_interval - time.monotonic())
+        self._edit_task = asyncio.create_task(self._progress_edit(delay))
+
+    async def _progress_edit(self, delay: float):
+        await asyncio.sleep(delay)
+        if not self._response.strip():
+            return
+        view = None
+        if len(self._response) <= PROGRESS_TEXT_LIMIT:
+            # Component text is never longer than the raw response so the snapshot fits too
+            try:
+                view = self._stream_parser.snapshot()
+            except Exception:
+                pass  # Partial markup can be invalid until the component is closed
+        if view is None:
+            view = discord.ui.LayoutView(timeout=1)
+            text = self._response
+            if len(text) > PROGRESS_TEXT_LIMIT:
+                text = "…" + text[-(PROGRESS_TEXT_LIMIT - 1):]  # Show the latest part while streaming
+            view.add_item(discord.ui.TextDisplay(text))
+        view.add_item(discord.ui.TextDisplay("-# " + self.client.emojis["typing"]))
+        self._last_edit = time.monotonic()
+        try:
+            await self._response_message.edit(view=view)
+        except discord.HTTPException as e:
+            print(f"Error editing streamed response: {e}")
+
+    async def cancel_progress_edit(self):
+        if self._edit_task is None or self._edit_task.done():
+            return
+        self._edit_task.cancel()
+        try:
+            await self._edit_task
+        except asyncio.CancelledError:
+            pass
+
     def typing_view(self):
         view = discord.ui.LayoutView(timeout=1)
         view.add_item(discord.ui.TextDisplay("-# " + self.client.emojis["typing"]))
@@ -102,6 +173,7 @@ class AIContext:
         self._response_message = await self.message.reply(view=self.typing_view())
 
     async def finish_response(self):
+        await self.cancel_progress_edit()
         if not self._response.strip():
             return
         kwargs = self._gen_kwargs()
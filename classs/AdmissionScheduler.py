@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+
+class SchedulerBusy(Exception):
+    pass
+
+
+class Waiter:
+    def __init__(self, guild_id: int, user_id: int, tag: float, future: asyncio.Future):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.tag = tag
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class AdmissionScheduler:
+    """
+    Admission control for AI requests.
+    At most `max_active` requests run at once, with per guild and per user caps.
+    Waiting requests are served by weighted fair queueing across guilds: each
+    request gets a virtual finish tag of max(virtual time, guild's last tag) + 1 / weight
+    and the eligible request with the smallest tag runs next, so a busy guild
+    cannot starve a quiet one. The queue is bounded and full queues raise SchedulerBusy.
+    """
+
+    def __init__(self, max_active: int, max_per_guild: int, max_per_user: int,
+                 max_queue: int, max_queued_per_user: int, guild_weights: Optional[Dict[int, float]] = None):
+        self.max_active = max_active
+        self.max_per_guild = max_per_guild
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.guild_weights = guild_weights or {}
+        self.queue: List[Waiter] = []
+        self.active = 0
+        self.active_guilds: Dict[int, int] = {}
+        self.active_users: Dict[int, int] = {}
+        self.last_tags: Dict[int, float] = {}
+        self.virtual_time = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.wait_times = deque(maxlen=1000)
+
+    def _eligible(self, guild_id: int, user_id: int) -> bool:
+        return (self.active < self.max_active and
+                self.active_guilds.get(guild_id, 0) < self.max_per_guild and
+                self.active_users.get(user_id, 0) < self.max_per_user)
+
+    def _start(self, guild_id: int, user_id: int):
+        self.active += 1
+        self.active_guilds[guild_id] = self.active_guilds.get(guild_id, 0) + 1
+        self.active_users[user_id] = self.active_users.get(user_id, 0) + 1
+        self.admitted += 1
+
+    def _release(self, guild_id: int, user_id: int):
+        self.active -= 1
+        for counts, key in ((self.active_guilds, guild_id), (self.active_users, user_id)):
+            counts[key] -= 1
+            if counts[key] <= 0:
+                del counts[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.queue and self.active < self.max_active:
+            candidates = [w for w in self.queue if self._eligible(w.guild_id, w.user_id) and not w.future.done()]
+            if not candidates:
+                return
+            waiter = min(candidates, key=lambda w: w.tag)
+            self.queue.remove(waiter)
+            self.virtual_time = max(self.virtual_time, waiter.tag)
+            self._start(waiter.guild_id, waiter.user_id)
+            self.wait_times.append(time.monotonic() - waiter.enqueued)
+            waiter.future.set_result(None)
+        if not self.queue:
+            # Idle, restart virtual time so old tags do not penalize returning guilds
+            self.last_tags.clear()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, guild_id: int, user_id: int):
+        """
+        Wait for a slot for this guild and user, raises SchedulerBusy when the queue is full.
+        """
+        if not self.queue and self._eligible(guild_id, user_id):
+            self._start(guild_id, user_id)
+            self.wait_times.append(0.0)
+        else:
+            queued_by_user = sum(1 for w in self.queue if w.user_id == user_id)
+            if len(self.queue) >= self.max_queue or queued_by_user >= self.max_queued_per_user:
+                self.rejected += 1
+                raise SchedulerBusy()
+            weight = self.guild_weights.get(guild_id, 1.0)
+            tag = max(self.virtual_time, self.last_tags.get(guild_id, 0.0)) + 1.0 / weight
+            self.last_tags[guild_id] = tag
+            waiter = Waiter(guild_id, user_id, tag, asyncio.get_running_loop().create_future())
+            self.queue.append(waiter)
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+            self._dispatch()  # Others may be waiting only on their own guild or user caps
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter in self.queue:
+                    self.queue.remove(waiter)
+                elif waiter.future.done() and not waiter.future.cancelled():
+                    self._release(guild_id, user_id)  # Granted just before the cancel arrived
+                raise
+        try:
+            yield
+        finally:
+            self._release(guild_id, user_id)
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+
+        def percentile(p: float) -> float:
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            "active": self.active,
+            "queue_depth": len(self.queue),
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_p50": percentile(0.5),
+            "wait_p99": percentile(0.99)
+        }
@@ -0,0 +1,11 @@
+import os
+import sqlite3
+
+
+def connect_cache_db(path: str) -> sqlite3.Connection:
+    """Open a disk cache database shared by every cluster process."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # WAL lets readers run during a write, the timeout makes writers wait their turn instead of failing
+    db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
@@ -0,0 +1,55 @@
+import asyncio
+import time
+from typing import Dict, List, Tuple
+
+from google_custom_search import CustomSearch, Item
+
+from classs.LRUCache import LRUCache
+
+
+class CachedSearchClient:
+    """
+    Wraps a CustomSearch client with a TTL cache keyed by normalized query.
+    Concurrent identical searches share a single outbound request.
+    """
+    cache: LRUCache[Tuple, Tuple[float, List[Item]]]
+
+    def __init__(self, client: CustomSearch, size: int, ttl: float):
+        self.client = client
+        self.ttl = ttl
+        self.cache = LRUCache(size)
+        self.in_flight: Dict[Tuple, asyncio.Task] = {}
+        self.coalesced = 0
+        self.requests = 0
+
+    @staticmethod
+    def key(query: str, *args, **kwargs) -> Tuple:
+        return (" ".join(query.lower().split()), args, tuple(sorted(kwargs.items())))
+
+    async def _request(self, key: Tuple, query: str, args, kwargs) -> List[Item]:
+        try:
+            self.requests += 1
+            results = await self.client.search(query, *args, **kwargs)
+            self.cache.set(key, (time.monotonic() + self.ttl, results))
+            return results
+        finally:
+            del self.in_flight[key]
+
+    async def search(self, query: str, *args, **kwargs) -> List[Item]:
+        key = self.key(query, *args, **kwargs)
+        entry = self.cache.get(key)
+        if entry is not None and time.monotonic() < entry[0]:
+            return list(entry[1])
+        if key in self.in_flight:
+            self.coalesced += 1
+        else:
+            # Runs as its own task so one cancelled caller does not fail the others
+            self.in_flight[key] = asyncio.create_task(self._request(key, query, args, kwargs))
+        return list(await asyncio.shield(self.in_flight[key]))
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            "requests": self.requests,
+            "coalesced": self.coalesced
+        }
@@ -0,0 +1,166 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from typing import Dict, List
+
+import aiohttp
+from dotenv import load_dotenv
+
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+RESTART_DELAY = 5
+# Top level FClient.stats() counters that add up across clusters
+SUMMED_STATS = ("shards", "guilds", "active_requests", "queued_requests", "rejected_requests",
+                "llm_calls", "prompt_tokens", "cached_prompt_tokens", "history_rest_fetches")
+
+
+def load_config():
+    """Load .env outside Docker, shared by the launcher and every cluster process."""
+    if os.getenv('IS_DOCKER') is None:
+        load_dotenv()
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[List[int]]:
+    """Split shards into contiguous ranges, one per process, sizes differ by at most one."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def fetch_shard_count(token: str) -> int:
+    """Shard count recommended by Discord for this bot."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_URL, headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data["shards"]
+
+
+def run_cluster(cluster_id: int, cluster_count: int, shard_ids: List[int], shard_count: int, stats_queue):
+    """Entry point of a cluster process, runs one FClient owning `shard_ids`."""
+    load_config()
+    # Stop like Ctrl+C so the client closes its modules and connections
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    from classs.FClient import FClient
+
+    client = FClient(shard_ids=shard_ids, shard_count=shard_count, cluster_id=cluster_id,
+                     cluster_count=cluster_count, stats_queue=stats_queue)
+    client.run(os.getenv('BOT_TOKEN'))
+
+
+class Cluster:
+    """
+    Runs the bot as several processes, each an FClient owning a contiguous range of shards.
+    Processes are started one after another, the next once the previous reports ready,
+    so their gateway identifies do not collide. Clusters send their stats to the
+    launcher over a multiprocessing queue, the launcher prints the aggregate and
+    restarts clusters that exit.
+    """
+
+    def __init__(self, token: str, processes: int, shard_count: int, stats_interval: float):
+        self.token = token
+        self.process_count = processes
+        self.shard_count = shard_count
+        self.stats_interval = stats_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.queue = self.context.Queue()
+        self.ranges: List[List[int]] = []
+        self.processes: Dict[int, BaseProcess] = {}
+        self.cluster_stats: Dict[int, dict] = {}
+        self.ready = set()
+        self.restarts = 0
+
+    def _start(self, cluster_id: int):
+        process = self.context.Process(
+            target=run_cluster,
+            args=(cluster_id, len(self.ranges), self.ranges[cluster_id], self.shard_count, self.queue),
+            name=f"cluster-{cluster_id}"
+        )
+        process.start()
+        self.processes[cluster_id] = process
+        self.ready.discard(cluster_id)
+        print(f"Cluster {cluster_id} started with shards {self.ranges[cluster_id][0]}-{self.ranges[cluster_id][-1]} "
+              f"(pid {process.pid})")
+
+    def _receive(self, timeout: float):
+        try:
+            kind, cluster_id, data = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if kind == "ready":
+            self.ready.add(cluster_id)
+        elif kind == "stats":
+            self.cluster_stats[cluster_id] = data
+
+    def _wait_ready(self, cluster_id: int):
+        # Roughly one identify every 5 seconds per shard plus guild loading
+        deadline = time.monotonic() + 60 + 10 * len(self.ranges[cluster_id])
+        while cluster_id not in self.ready and time.monotonic() < deadline:
+            if not self.processes[cluster_id].is_alive():
+                return
+            self._receive(timeout=1)
+        if cluster_id not in self.ready:
+            print(f"Cluster {cluster_id} not ready in time, starting the next one anyway")
+
+    def _check_processes(self):
+        for cluster_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            print(f"Cluster {cluster_id} exited with code {process.exitcode}, restarting in {RESTART_DELAY}s")
+            self.cluster_stats.pop(cluster_id, None)
+            self.restarts += 1
+            time.sleep(RESTART_DELAY)
+            self._start(cluster_id)
+            self._wait_ready(cluster_id)
+
+    def stats(self) -> dict:
+        clusters = list(self.cluster_stats.values())
+        latencies = [s["latency"] for s in clusters if s.get("latency") == s.get("latency")]  # Skip NaN
+        return {
+            "clusters": len(self.processes),
+            "ready": len(self.ready),
+            "reporting": len(clusters),
+            "restarts": self.restarts,
+            **{key: sum(s.get(key, 0) for s in clusters) for key in SUMMED_STATS},
+            "max_latency": max(latencies, default=0.0)
+        }
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            if self.shard_count <= 0:
+                self.shard_count = asyncio.run(fetch_shard_count(self.token))
+            self.ranges = shard_ranges(self.shard_count, self.process_count)
+            print(f"Launching {len(self.ranges)} clusters for {self.shard_count} shards")
+            for cluster_id in range(len(self.ranges)):
+                self._start(cluster_id)
+                self._wait_ready(cluster_id)
+            next_report = time.monotonic() + self.stats_interval
+            while True:
+                self._receive(timeout=1)
+                self._check_processes()
+                if time.monotonic() >= next_report:
+                    next_report = time.monotonic() + self.stats_interval
+                    print(f"Cluster stats: {self.stats()}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
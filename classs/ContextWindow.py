@@ -0,0 +1,160 @@
+import json
+from typing import List, Optional
+
+from classs.LRUCache import LRUCache
+
+MESSAGE_OVERHEAD = 4
+ELIDED = "[Earlier tool output removed to fit the context window ({tokens} tokens). Call the tool again if it is needed.]"
+TRUNCATED = "\n\n[... {tokens} tokens truncated to fit the context window]"
+
+
+class ContextWindow:
+    """
+    Keeps the prompt sent to the model under a token budget.
+    Tokens are counted with a Hugging Face tokenizer when `tokenizer` is set,
+    otherwise estimated at 4 characters per token. When a prompt is over budget
+    it is reduced in this order until it fits:
+    1. tool outputs from earlier tool rounds are replaced with a short note
+    2. long messages are truncated, oldest first
+    3. the oldest history messages are dropped, an assistant tool call is
+       always dropped together with its tool outputs
+    The system prompts (the main one and the per request context) and the
+    latest user request are kept intact.
+    """
+
+    def __init__(self, budget: int, tokenizer: Optional[str], tool_output_tokens: int,
+                 message_tokens: int, image_tokens: int):
+        self.budget = budget
+        self.tool_output_tokens = tool_output_tokens
+        self.message_tokens = message_tokens
+        self.image_tokens = image_tokens
+        self.tokenizer = None
+        self.counts = LRUCache(4096)
+        self.elided = 0
+        self.truncated = 0
+        self.dropped = 0
+        if tokenizer:
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+                self.tokenizer.model_max_length = 10 ** 9  # Only counting, silence the length warning
+            except Exception as e:
+                print(f"Error loading tokenizer {tokenizer}, estimating tokens instead: {e}")
+
+    def count_text(self, text: str) -> int:
+        if self.tokenizer is None or len(text) < 64:
+            return (len(text) + 3) // 4
+        # Keyed by hash so the cache does not keep whole prompts alive, str caches its own hash
+        key = (len(text), hash(text))
+        tokens = self.counts.get(key)
+        if tokens is None:
+            tokens = len(self.tokenizer.encode(text, add_special_tokens=False))
+            self.counts.set(key, tokens)
+        return tokens
+
+    def count(self, message: dict) -> int:
+        tokens = MESSAGE_OVERHEAD
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += self.count_text(part["text"])
+                elif part.get("type") == "image_url":
+                    tokens += self.image_tokens
+                else:
+                    tokens += self.count_text(json.dumps(part, default=str))
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call["function"]
+            tokens += self.count_text(function["name"]) + self.count_text(function["arguments"] or "")
+        return tokens
+
+    def _truncate_text(self, text: str, limit: int) -> str:
+        tokens = self.count_text(text)
+        if tokens <= limit:
+            return text
+        keep = int(len(text) * limit / tokens)
+        return text[:keep] + TRUNCATED.format(tokens=tokens - limit)
+
+    def _truncate(self, message: dict, limit: int) -> dict:
+        content = message.get("content")
+        if isinstance(content, str):
+            return {**message, "content": self._truncate_text(content, limit)}
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if part.get("type") == "text":
+                    part = {**part, "text": self._truncate_text(part["text"], max(0, limit))}
+                    limit -= self.count_text(part["text"])
+                parts.append(part)
+            return {**message, "content": parts}
+        return message
+
+    def fit(self, messages: List[dict], tools: Optional[List[dict]] = None) -> List[dict]:
+        """
+        Return messages reduced to fit the budget, the given list is not modified.
+        Tool schemas are sent with every request so they are charged to the budget first.
+        """
+        budget = self.budget - (self.count_text(json.dumps(tools)) if tools else 0)
+        counts = [self.count(message) for message in messages]
+        total = sum(counts)
+        if total <= budget:
+            return messages
+
+        messages = list(messages)
+        first = 1 if messages and messages[0].get("role") == "system" else 0
+        request = max((i for i, m in enumerate(messages) if m.get("role") in ("user", "developer")), default=first)
+        latest_calls = max((i for i, m in enumerate(messages) if m.get("tool_calls")), default=-1)
+
+        def replace(index: int, message: dict):
+            nonlocal total
+            messages[index] = message
+            count = self.count(message)
+            total += count - counts[index]
+            counts[index] = count
+
+        for i in range(first, latest_calls):
+            if total <= budget:
+                break
+            if messages[i].get("role") == "tool" and counts[i] > 64:
+                replace(i, {**messages[i], "content": ELIDED.format(tokens=counts[i])})
+                self.elided += 1
+
+        def pinned(index: int) -> bool:
+            return index == request or messages[index].get("role") == "system"
+
+        for i in range(first, len(messages)):
+            if total <= budget:
+                break
+            limit = self.tool_output_tokens if messages[i].get("role") == "tool" else self.message_tokens
+            if not pinned(i) and counts[i] > limit:
+                replace(i, self._truncate(messages[i], limit))
+                self.truncated += 1
+
+        while total > budget:
+            start = next((i for i in range(first, request) if not pinned(i)), None)
+            if start is None:
+                break
+            end = start + 1
+            while end < len(messages) and messages[end].get("role") == "tool":
+                end += 1
+            total -= sum(counts[start:end])
+            self.dropped += end - start
+            request -= end - start
+            del messages[start:end]
+            del counts[start:end]
+
+        if total > budget:
+            replace(request, self._truncate(messages[request], max(self.message_tokens, budget - (total - counts[request]))))
+            self.truncated += 1
+        return messages
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "tokenizer": self.tokenizer is not None,
+            "elided": self.elided,
+            "truncated": self.truncated,
+            "dropped": self.dropped
+        }
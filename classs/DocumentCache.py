@@ -0,0 +1,218 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Mapping
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from classs.CacheDB import connect_cache_db
+
+TRACKING_PARAMS = re.compile(r"^(utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|ref_src)$", re.IGNORECASE)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonical_url(url: str) -> str:
+    """
+    Normalize a URL so trivially different spellings share one cache entry:
+    lowercase scheme and host, no default port, no fragment, no tracking
+    parameters and sorted query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port is not None and DEFAULT_PORTS.get(scheme) != parts.port:
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        host = f"{parts.username}@{host}"
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not TRACKING_PARAMS.match(name)
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class CachedDocument:
+    def __init__(self, url: str, markdown: str, etag: Optional[str], last_modified: Optional[str], expires: float):
+        self.url = url
+        self.markdown = markdown
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+    def fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def validators(self) -> dict:
+        """Headers for a conditional request revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class DocumentCache:
+    """
+    On-disk cache of converted documents keyed by canonical URL.
+    Freshness follows Cache-Control, Expires and Last-Modified, stale entries
+    keep their ETag and Last-Modified for revalidation and the least recently
+    used entries are evicted once the stored markdown exceeds `max_bytes`.
+    """
+
+    def __init__(self, path: Optional[str], max_bytes: int, default_ttl: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect_cache_db(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "url TEXT PRIMARY KEY, markdown TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+                "expires REAL NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS documents_accessed ON documents (accessed)")
+        return self._db
+
+    def _expires(self, headers: Mapping[str, str]) -> Optional[float]:
+        """
+        Absolute expiry time from response headers, None when the response must not be stored.
+        """
+        now = time.time()
+        directives = {}
+        for directive in headers.get("Cache-Control", "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name] = value.strip('"')
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return now
+        for name in ("s-maxage", "max-age"):
+            if directives.get(name, "").isdigit():
+                age = int(headers.get("Age", "0")) if headers.get("Age", "").isdigit() else 0
+                return now + max(0, int(directives[name]) - age)
+        expires = _parse_http_date(headers.get("Expires"))
+        if expires is not None:
+            date = _parse_http_date(headers.get("Date")) or now
+            return now + max(0.0, expires - date)
+        last_modified = _parse_http_date(headers.get("Last-Modified"))
+        if last_modified is not None:
+            # Heuristic freshness: a tenth of the time since the last change
+            return now + min(self.default_ttl, max(0.0, (now - last_modified) / 10))
+        return now + self.default_ttl
+
+    def _disk_get(self, url: str) -> Optional[CachedDocument]:
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT markdown, etag, last_modified, expires FROM documents WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE documents SET accessed = ? WHERE url = ?", (time.time(), url))
+            db.commit()
+        return CachedDocument(url, *row)
+
+    def _disk_set(self, document: CachedDocument):
+        size = len(document.markdown.encode("utf8"))
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO documents (url, markdown, etag, last_modified, expires, size, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (document.url, document.markdown, document.etag, document.last_modified,
+                 document.expires, size, time.time())
+            )
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+            if total > self.max_bytes:
+                evict = []
+                for url, entry_size in db.execute("SELECT url, size FROM documents ORDER BY accessed"):
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((url,))
+                    total -= entry_size
+                db.executemany("DELETE FROM documents WHERE url = ?", evict)
+            db.commit()
+
+    def _disk_refresh(self, url: str, expires: float, etag: Optional[str], last_modified: Optional[str]):
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "UPDATE documents SET expires = ?, etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified), accessed = ? WHERE url = ?",
+                (expires, etag, last_modified, time.time(), url)
+            )
+            db.commit()
+
+    async def get(self, url: str) -> Optional[CachedDocument]:
+        """
+        Look up a document, fresh or stale. Callers check `fresh()` and
+        revalidate stale entries with `validators()`.
+        """
+        if not self.path:
+            return None
+        try:
+            document = await asyncio.to_thread(self._disk_get, canonical_url(url))
+        except sqlite3.Error as e:
+            print(f"Error reading document cache: {e}")
+            return None
+        if document is None:
+            self.misses += 1
+        elif document.fresh():
+            self.hits += 1
+        return document
+
+    async def set(self, url: str, markdown: str, headers: Mapping[str, str]):
+        if not self.path:
+            return
+        expires = self._expires(headers)
+        if expires is None:
+            return
+        document = CachedDocument(
+            canonical_url(url), markdown, headers.get("ETag"), headers.get("Last-Modified"), expires
+        )
+        try:
+            await asyncio.to_thread(self._disk_set, document)
+        except sqlite3.Error as e:
+            print(f"Error writing document cache: {e}")
+
+    async def revalidate(self, document: CachedDocument, headers: Mapping[str, str]):
+        """Extend a stale entry after the server answered 304 Not Modified."""
+        self.revalidated += 1
+        expires = self._expires(headers)
+        if expires is None:
+            expires = time.time()
+        document.expires = expires
+        try:
+            await asyncio.to_thread(
+                self._disk_refresh, document.url, expires, headers.get("ETag"), headers.get("Last-Modified")
+            )
+        except sqlite3.Error as e:
+            print(f"Error writing document cache: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.revalidated + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.revalidated) / total if total else 0.0
+        }
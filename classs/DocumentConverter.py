@@ -0,0 +1,179 @@
+import asyncio
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, Optional, Tuple, Union
+
+from markitdown import MarkItDown, StreamInfo
+
+from classs.HTMLExtractor import HTMLExtractor
+
+TEXT_TYPES = {"text/plain", "text/markdown", "text/x-markdown"}
+JSON_TYPES = {"application/json", "text/json"}
+HTML_TYPES = {"text/html", "application/xhtml+xml"}
+
+_markitdown: Optional[MarkItDown] = None
+
+
+def _init_worker():
+    global _markitdown
+    _markitdown = MarkItDown(enable_plugins=True, enable_builtins=True)
+
+
+def _convert(source: Union[bytes, str], mimetype: Optional[str], charset: Optional[str]) -> str:
+    """Convert raw bytes or a file path to markdown with this worker's MarkItDown."""
+    if _markitdown is None:
+        _init_worker()
+    stream_info = StreamInfo(mimetype=mimetype, charset=charset)
+    with (io.BytesIO(source) if isinstance(source, bytes) else open(source, "rb")) as stream:
+        return _markitdown.convert(stream, stream_info=stream_info).markdown
+
+
+def fast_convert(source: Union[bytes, str], mimetype: Optional[str], charset: Optional[str]) -> Optional[str]:
+    """
+    Convert plain text, JSON and HTML without MarkItDown.
+    Returns None when the type is not handled or the body needs the full converter.
+    """
+    mimetype = (mimetype or "").lower()
+    is_json = mimetype in JSON_TYPES or mimetype.endswith("+json")
+    if mimetype not in TEXT_TYPES and mimetype not in HTML_TYPES and not is_json:
+        return None
+    if not isinstance(source, bytes):
+        with open(source, "rb") as file:
+            source = file.read()
+    try:
+        text = source.decode(charset or "utf-8")
+    except (LookupError, UnicodeDecodeError):
+        return None  # Unknown encoding, let MarkItDown detect it
+    if is_json:
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return text.strip()
+        return json.dumps(data, indent=2, ensure_ascii=False)
+    if mimetype in HTML_TYPES:
+        return HTMLExtractor.extract(text)
+    return text.strip()
+
+
+def _convert_document(source: Union[bytes, str], mimetype: Optional[str], charset: Optional[str],
+                      fast_paths: bool) -> Tuple[str, bool]:
+    """Worker entry point, tries the fast path first. Returns the markdown and whether the fast path made it."""
+    if fast_paths:
+        markdown = fast_convert(source, mimetype, charset)
+        if markdown is not None:
+            return markdown, True
+    return _convert(source, mimetype, charset), False
+
+
+class ConverterBusy(Exception):
+    pass
+
+
+class DocumentConverter:
+    """
+    Runs MarkItDown in a pool of worker processes so CPU heavy conversions
+    do not hold the GIL of the event loop. At most `workers` conversions run
+    at once, `max_pending` may wait, and a conversion running past `timeout`
+    seconds kills the pool which is recreated for the next call. The pool
+    cannot tell which worker runs a task, so conversions that were running
+    alongside the killed one are retried once on the new pool.
+    With `workers` set to 0 conversions run in a thread instead.
+    With `fast_paths` set plain text and JSON are converted in a thread, HTML
+    parsing is CPU bound so its fast path runs in the worker.
+    """
+
+    def __init__(self, workers: int, timeout: float, max_pending: int, fast_paths: bool = True):
+        self.workers = workers
+        self.fast_paths = fast_paths
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.pending = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.retries = 0
+        self.fast_converted = 0
+        self._slots = asyncio.Semaphore(max(1, workers))
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker
+            )
+        return self.pool
+
+    def _kill_pool(self):
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        # noinspection PyProtectedMember
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        # Without cancel_futures every queued or running conversion fails with BrokenProcessPool and can retry
+        pool.shutdown(wait=False)
+        self.restarts += 1
+
+    async def convert(self, body: BinaryIO, mimetype: Optional[str], charset: Optional[str]) -> str:
+        """
+        Convert a downloaded body, in memory bodies are sent to the worker
+        as bytes and bodies spilled to disk by file name.
+        """
+        source = body.getvalue() if isinstance(body, io.BytesIO) else body.name
+        if self.fast_paths and (mimetype or "").lower() not in HTML_TYPES:
+            markdown = await asyncio.to_thread(fast_convert, source, mimetype, charset)
+            if markdown is not None:
+                self.fast_converted += 1
+                return markdown
+        if self.pending >= self.max_pending:
+            raise ConverterBusy("Too many documents waiting for conversion")
+        self.pending += 1
+        try:
+            async with self._slots:
+                if self.workers <= 0:
+                    markdown, fast = await asyncio.wait_for(
+                        asyncio.to_thread(_convert_document, source, mimetype, charset, self.fast_paths), self.timeout
+                    )
+                    self.fast_converted += fast
+                    return markdown
+                for attempt in range(2):
+                    pool = self._get_pool()
+                    future = asyncio.get_running_loop().run_in_executor(
+                        pool, _convert_document, source, mimetype, charset, self.fast_paths
+                    )
+                    try:
+                        markdown, fast = await asyncio.wait_for(future, self.timeout)
+                        self.fast_converted += fast
+                        return markdown
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        if self.pool is pool:
+                            self._kill_pool()
+                        raise
+                    except BrokenProcessPool:
+                        if self.pool is pool:
+                            self._kill_pool()  # A worker crashed on its own, start over
+                        if attempt:
+                            raise
+                        self.retries += 1
+        finally:
+            self.pending -= 1
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "retries": self.retries,
+            "fast_converted": self.fast_converted
+        }
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from classs.CacheDB import connect_cache_db
+from classs.LRUCache import LRUCache
+
+
+class EmbeddingCache:
+    """
+    Content addressed embedding cache keyed by (model, hash of normalized text).
+    An in-memory LRU sits in front of a SQLite file, vectors are stored as
+    float16 in both tiers and expire after `ttl` seconds.
+    """
+    memory: LRUCache[str, Tuple[float, np.ndarray]]
+
+    def __init__(self, path: Optional[str], memory_size: int, max_entries: int, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = LRUCache(memory_size)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{model}\0{normalized}".encode("utf8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect_cache_db(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+        return self._db
+
+    def _disk_get(self, keys: List[str]) -> dict:
+        now = time.time()
+        found = {}
+        with self._lock:
+            db = self._connect()
+            for key in keys:
+                row = db.execute("SELECT vector, created FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                if now - row[1] > self.ttl:
+                    db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                    continue
+                found[key] = (row[1], np.frombuffer(row[0], dtype=np.float16))
+                db.execute("UPDATE embeddings SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+        return found
+
+    def _disk_set(self, items: List[Tuple[str, np.ndarray]]):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created, accessed) VALUES (?, ?, ?, ?)",
+                [(key, vector.tobytes(), now, now) for key, vector in items]
+            )
+            overflow = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                db.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)",
+                    (overflow,)
+                )
+            db.commit()
+
+    async def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        keys = [self.key(model, text) for text in texts]
+        now = time.time()
+        vectors: List[Optional[np.ndarray]] = [None] * len(keys)
+        missing = []
+        for index, key in enumerate(keys):
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                vectors[index] = entry[1].astype(np.float32)
+                self.memory_hits += 1
+            else:
+                missing.append(index)
+        if missing and self.path:
+            try:
+                found = await asyncio.to_thread(self._disk_get, [keys[i] for i in missing])
+            except sqlite3.Error as e:
+                print(f"Error reading embedding cache: {e}")
+                found = {}
+            for index in missing:
+                if keys[index] in found:
+                    self.memory.set(keys[index], found[keys[index]])
+                    vectors[index] = found[keys[index]][1].astype(np.float32)
+                    self.disk_hits += 1
+        self.misses += sum(1 for vector in vectors if vector is None)
+        return vectors
+
+    async def set_many(self, model: str, texts: List[str], vectors: List[np.ndarray]):
+        now = time.time()
+        items = []
+        for text, vector in zip(texts, vectors):
+            key = self.key(model, text)
+            half = np.asarray(vector, dtype=np.float16)
+            self.memory.set(key, (now, half))
+            items.append((key, half))
+        if items and self.path:
+            try:
+                await asyncio.to_thread(self._disk_set, items)
+            except sqlite3.Error as e:
+                print(f"Error writing embedding cache: {e}")
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self.memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0
+        }
@@ -1,42 +1,121 @@
+import asyncio
+import contextlib
 import datetime
 import json
 import os
+import time
 import traceback
-from typing import List
+from typing import List, Dict, Tuple, Optional
 import base64
 import aiohttp
 import discord
+from multiprocessing.queues import Queue
 from string import Template
 
 from discord.ui import LayoutView
 from google_custom_search import CustomSearch, AiohttpAdapter
 
 from classs.AIContext import AIContext
-from openai import AsyncAzureOpenAI, BadRequestError, AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
+from openai import AsyncAzureOpenAI, BadRequestError, AsyncOpenAI, AsyncStream
+from openai.types.chat import ChatCompletionMessageParam, ChatCompletionChunk
 from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
+from openai.types.completion_usage import CompletionUsage
 from huggingface_hub import AsyncInferenceClient
 
+from classs.AdmissionScheduler import AdmissionScheduler, SchedulerBusy
+from classs.CachedSearchClient import CachedSearchClient
+from classs.ContextWindow import ContextWindow
 from classs.FormatMessages import FormatMessages
+from classs.HistoryCache import HistoryCache
+from classs.LLMClient import LLMClient
 from classs.MCPManager import MCPManager
 
+BUSY_MESSAGE = "I'm handling too many requests right now, please try again in a moment."
+BUDGET_MESSAGE = "I couldn't finish this request, please try again or ask something narrower."
+FINAL_ANSWER_TIMEOUT = 60  # Seconds the forced final answer may take once a budget is used up
 
-class FClient(discord.Client):
+
+class FClient(discord.AutoShardedClient):
     mcp_manager: MCPManager
     openai: AsyncAzureOpenAI | AsyncOpenAI
+    llm: LLMClient
     huggingface: AsyncInferenceClient | None
     system_prompt: Template
     emojis: dict = {}
     functions = {}
     functions_json_schema = []
-    google_search_client: CustomSearch = None
+    module_functions: dict
+    modules: list
+    google_search_client: CachedSearchClient = None
     format_messages: FormatMessages
-
-    def __init__(self, **options):
+    history_cache: HistoryCache
+    history_limit: int
+    stream: bool
+    stream_usage: bool
+    stable_prompt: bool
+    tool_call_concurrency: int
+    tool_semaphores: Dict[str, asyncio.Semaphore]
+    tool_output_limit: int
+    tool_output_limits: Dict[str, int]
+    scheduler: AdmissionScheduler
+    context_window: ContextWindow
+    cluster_id: int
+    cluster_count: int
+    stats_queue: Optional[Queue]
+    stats_interval: float
+
+    def __init__(self, shard_ids: Optional[List[int]] = None, shard_count: Optional[int] = None,
+                 cluster_id: int = 0, cluster_count: int = 1, stats_queue: Optional[Queue] = None, **options):
         intents = discord.Intents.all()
+        self.cluster_id = cluster_id
+        self.cluster_count = cluster_count
+        self.stats_queue = stats_queue  # Set when run by a Cluster launcher
+        self.stats_interval = float(os.getenv('CLUSTER_STATS_INTERVAL', '60'))
+        self.stats_task = None
         self.load_open_ai(**options)
+        self.stream = os.getenv('OPENAI_STREAM', '0') == '1'
+        self.stream_usage = os.getenv('OPENAI_STREAM_USAGE', '1') == '1'
+        self.stable_prompt = os.getenv('STABLE_PROMPT_PREFIX', '1') == '1'
+        self.tool_call_concurrency = int(os.getenv('TOOL_CALL_CONCURRENCY', '4'))
+        self.tool_semaphores = {}
+        self.agent_max_steps = int(os.getenv('AGENT_MAX_STEPS', '12'))
+        self.agent_max_seconds = float(os.getenv('AGENT_MAX_SECONDS', '300'))
+        self.agent_max_tokens = int(os.getenv('AGENT_MAX_TOKENS', '300000'))
+        self.agent_max_tool_calls = int(os.getenv('AGENT_MAX_TOOL_CALLS', '32'))
+        self.tool_output_limit = int(os.getenv('TOOL_OUTPUT_LIMIT', '12000'))
+        self.tool_output_limits = {
+            name.strip(): int(limit) for name, _, limit in (
+                entry.partition(':') for entry in os.getenv('TOOL_OUTPUT_LIMITS', '').split(',') if entry.strip()
+            )
+        }
         self.load_huggingface()
         self.mcp_manager = MCPManager()
+        self.module_functions = {}
+        self.modules = []
+        self.history_limit = int(os.getenv('HISTORY_LIMIT', '10'))
+        self.history_cache = HistoryCache(
+            size=max(int(os.getenv('HISTORY_CACHE_SIZE', '50')), self.history_limit),
+            max_channels=int(os.getenv('HISTORY_CACHE_CHANNELS', '1000'))
+        )
+        self.context_window = ContextWindow(
+            budget=int(os.getenv('CONTEXT_BUDGET', '32000')),
+            tokenizer=os.getenv('CONTEXT_TOKENIZER') or None,
+            tool_output_tokens=int(os.getenv('CONTEXT_TOOL_OUTPUT_TOKENS', '4000')),
+            message_tokens=int(os.getenv('CONTEXT_MESSAGE_TOKENS', '1500')),
+            image_tokens=int(os.getenv('CONTEXT_IMAGE_TOKENS', '800'))
+        )
+        self.scheduler = AdmissionScheduler(
+            max_active=int(os.getenv('ADMISSION_MAX_ACTIVE', '16')),
+            max_per_guild=int(os.getenv('ADMISSION_MAX_PER_GUILD', '4')),
+            max_per_user=int(os.getenv('ADMISSION_MAX_PER_USER', '2')),
+            max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '64')),
+            max_queued_per_user=int(os.getenv('ADMISSION_MAX_QUEUED_PER_USER', '2')),
+            guild_weights={
+                int(guild): float(weight) for guild, _, weight in (
+                    entry.partition(':') for entry in os.getenv('ADMISSION_GUILD_WEIGHTS', '').split(',') if entry.strip()
+                )
+            }
+        )
         with open("resources/system_prompt.md", "r", encoding="utf8") as f:
             self.system_prompt = Template(
                 f.read()
@@ -46,24 +125,40 @@ class FClient(discord.Client):
                 self.emojis[k[6:].lower()] = v
         allowed_mentions = discord.AllowedMentions.none()
         allowed_mentions.replied_user = True
-        super().__init__(intents=intents, allowed_mentions=allowed_mentions)
+        super().__init__(intents=intents, allowed_mentions=allowed_mentions,
+                         shard_ids=shard_ids, shard_count=shard_count)
         self.format_messages = FormatMessages(self)
 
     def load_open_ai(self, **options):
-        if os.getenv('OPENAI_API_TYPE') == 'AZURE_OPENAI':
+        if os.getenv('OPENAI_API_TYPE', 'OPENAI') == 'AZURE_OPENAI':
             self.openai = AsyncAzureOpenAI(
                 azure_deployment=os.getenv('OPENAI_API_MODAL'),
                 **options
             )
-        elif os.getenv('OPENAI_API_TYPE') == 'OPENAI':
+        else:
             self.openai = AsyncOpenAI(
                 **options
             )
+        # Retries are handled by LLMClient so they can respect the shared rate limits
+        self.openai = self.openai.with_options(max_retries=0)
+        self.llm = LLMClient(
+            self.openai,
+            rpm=int(os.getenv('LLM_RPM', '0')),
+            tpm=int(os.getenv('LLM_TPM', '0')),
+            max_retries=int(os.getenv('LLM_MAX_RETRIES', '5')),
+            max_backoff=float(os.getenv('LLM_MAX_BACKOFF', '60')),
+            completion_tokens=int(os.getenv('LLM_COMPLETION_TOKENS', '1024')),
+            share=1 / self.cluster_count  # LLM_RPM / LLM_TPM are for the whole bot, split across clusters
+        )
 
     def load_google_search(self):
         if os.getenv('GOOGLE_API_KEY') and os.getenv('GOOGLE_SEARCH_ENGINE_ID'):
-            self.google_search_client = CustomSearch(
-                AiohttpAdapter(apikey=os.getenv('GOOGLE_API_KEY'), engine_id=os.getenv('GOOGLE_SEARCH_ENGINE_ID'))
+            self.google_search_client = CachedSearchClient(
+                CustomSearch(
+                    AiohttpAdapter(apikey=os.getenv('GOOGLE_API_KEY'), engine_id=os.getenv('GOOGLE_SEARCH_ENGINE_ID'))
+                ),
+                size=int(os.getenv('SEARCH_CACHE_SIZE', '1024')),
+                ttl=float(os.getenv('SEARCH_CACHE_TTL', '3600'))
             )
         else:
             self.google_search_client = None
@@ -77,6 +172,17 @@ class FClient(discord.Client):
             self.huggingface = None
 
     def get_system_prompt(self, message: discord.Message, **kwargs):
+        if self.stable_prompt:
+            # Same bytes for every request so the provider can reuse its cached prefix
+            return self.system_prompt.safe_substitute(
+                current_time="(see request context)",
+                current_date="(see request context)",
+                bot_mention=self.user.mention,
+                bot_name=self.user.name,
+                channel_id="(see request context)",
+                channel_name="(see request context)",
+                **kwargs
+            )
         now = datetime.datetime.now(datetime.UTC)
         return self.system_prompt.safe_substitute(
             # Yes AI need know current time and date for realtime event searching
@@ -90,72 +196,297 @@ class FClient(discord.Client):
             **kwargs
         )
 
+    def get_request_context(self, message: discord.Message) -> str:
+        now = datetime.datetime.now(datetime.UTC)
+        return "\n".join([
+            "Request context (do not mention it in responses):",
+            f"- Current Date: `{now.strftime('%d/%m/%Y')}` (DD/MM/YYYY)",
+            f"- Current Time: `{now.strftime('%H:%M:%S')}` (hh:mm:ss 24-hour format, UTC)",
+            f"- Channel ID: `{message.channel.id}`",
+            f"- Channel Name: `{getattr(message.channel, 'name', None)}`",
+            f"- NSFW Channel: `{getattr(message.channel, 'nsfw', False)}`"
+        ])
+
+    def add_system_prompt(self, messages: List[ChatCompletionMessageParam], message: discord.Message):
+        """
+        Put the system prompt first. With a stable prompt the per request values
+        go in a separate message before the latest one, after the cacheable prefix.
+        """
+        messages.insert(0, {"role": "system", "content": self.get_system_prompt(message)})
+        if self.stable_prompt:
+            messages.insert(len(messages) - 1, {"role": "system", "content": self.get_request_context(message)})
+
     async def process_response(self, messages: List[ChatCompletionMessageParam], ctx: AIContext):
-        try:
-            response = await self.openai.chat.completions.create(
-                model=os.getenv('OPENAI_API_MODAL'),
-                messages=messages,
-                tools=self.functions_json_schema,
-                tool_choice="auto"
-            )
-        except BadRequestError as e:
-            messages = [messages[0]]
-            error_reason = e.response.json()["error"]["innererror"]["content_filter_result"]
-            messages.append({
-                "role": "system",
-                "content": f"User just make you error following reason: {error_reason}\nRespond with a text message to fix this error."
-            })
-            return await self.process_response(messages, ctx)
-        tool_calls = []
-        for choice in response.choices:
-            if choice.message.tool_calls:
-                for tool_call in choice.message.tool_calls:
-                    if tool_call.id:
-                        tool_calls.append(tool_call)
-                    else:
-                        tool_calls[-1].function.arguments += tool_call.function.arguments
-            elif choice.message.content is not None:
-                ctx.add_response(choice.message.content)
-        if tool_calls:
-            return await self.process_tool_calls(tool_calls, messages, ctx)
+        """
+        Agent loop: ask the model, run the tool calls it makes and repeat until it
+        answers without tools. When the step, time, token or tool call budget runs
+        out the model is asked once more for a final answer with tools disabled,
+        retried once on a rejected request before a fixed message is sent instead.
+        Model calls and tool rounds are cut off when the time budget runs out.
+        """
+        started = time.monotonic()
+        tokens = 0
+        tool_call_count = 0
+        final_attempts = 0
+        # System prompt and request context, kept when a rejected conversation is dropped
+        prompt = [message for message in messages if message["role"] == "system"]
+        while True:
+            remaining = self.agent_max_seconds - (time.monotonic() - started)
+            if ctx.budget_exhausted is None:
+                if len(ctx.steps) >= self.agent_max_steps - 1:
+                    ctx.budget_exhausted = "steps"  # The final answer is the last step
+                elif remaining <= 0:
+                    ctx.budget_exhausted = "time"
+                elif tokens >= self.agent_max_tokens:
+                    ctx.budget_exhausted = "tokens"
+                elif tool_call_count >= self.agent_max_tool_calls:
+                    ctx.budget_exhausted = "tool calls"
+            final = ctx.budget_exhausted is not None
+            if final:
+                if final_attempts >= 2:
+                    ctx.add_response(BUDGET_MESSAGE)
+                    break
+                final_attempts += 1
+                messages.append({
+                    "role": "system",
+                    "content": f"The {ctx.budget_exhausted} budget for this request is used up. "
+                               "Answer the user now with what you found so far, without calling tools."
+                })
+
+            step = {"step": len(ctx.steps) + 1, "llm_seconds": 0.0, "tool_seconds": 0.0, "tool_calls": 0, "tokens": 0}
+            ctx.steps.append(step)
+            step_started = time.monotonic()
+            response_length = len(ctx._response)
+            try:
+                tool_calls, step["tokens"] = await asyncio.wait_for(
+                    self.request_completion(messages, ctx, final),
+                    FINAL_ANSWER_TIMEOUT if final else remaining
+                )
+            except asyncio.TimeoutError:
+                step["llm_seconds"] = time.monotonic() - step_started
+                ctx.rollback_response(response_length)  # Drop the half streamed text of this step
+                if final:
+                    final_attempts = 2  # No time left for another try
+                ctx.budget_exhausted = ctx.budget_exhausted or "time"
+                continue
+            except BadRequestError as e:
+                step["llm_seconds"] = time.monotonic() - step_started
+                messages = list(prompt)
+                error_reason = e.response.json()["error"]["innererror"]["content_filter_result"]
+                messages.append({
+                    "role": "system",
+                    "content": f"User just make you error following reason: {error_reason}\nRespond with a text message to fix this error."
+                })
+                continue
+            step["llm_seconds"] = time.monotonic() - step_started
+            tokens += step["tokens"]
+            if not tool_calls or final:
+                if not ctx._response.strip():
+                    ctx.add_response(BUDGET_MESSAGE)
+                break
+
+            allowed = max(0, self.agent_max_tool_calls - tool_call_count)
+            step_started = time.monotonic()
+            remaining = self.agent_max_seconds - (time.monotonic() - started)
+            await self.process_tool_calls(tool_calls, messages, ctx, allowed, max(0.0, remaining))
+            step["tool_seconds"] = time.monotonic() - step_started
+            step["tool_calls"] = min(len(tool_calls), allowed)
+            tool_call_count += step["tool_calls"]
+        print(f"Agent loop finished in {time.monotonic() - started:.2f}s, {len(ctx.steps)} steps, "
+              f"{tool_call_count} tool calls, {tokens} tokens, budget exhausted: {ctx.budget_exhausted}")
         return ctx
 
+    async def request_completion(self, messages: List[ChatCompletionMessageParam], ctx: AIContext,
+                                 final: bool) -> Tuple[List[ChoiceDeltaToolCall], int]:
+        """
+        One model call. Returns the tool calls it asked for and the tokens it used,
+        estimated from the prompt when the provider does not report usage.
+        """
+        fitted = self.context_window.fit(messages, self.functions_json_schema)
+        response = await self.llm.create(
+            model=os.getenv('OPENAI_API_MODAL'),
+            messages=fitted,
+            tools=self.functions_json_schema,
+            tool_choice="none" if final else "auto",
+            stream=self.stream,
+            **({"stream_options": {"include_usage": True}} if self.stream and self.stream_usage else {})
+        )
+        if self.stream:
+            tool_calls, usage = await self.process_stream(response, ctx)
+        else:
+            usage = response.usage
+            tool_calls = []
+            for choice in response.choices:
+                if choice.message.tool_calls:
+                    for tool_call in choice.message.tool_calls:
+                        if tool_call.id:
+                            tool_calls.append(tool_call)
+                        else:
+                            tool_calls[-1].function.arguments += tool_call.function.arguments
+                elif choice.message.content is not None:
+                    ctx.add_response(choice.message.content)
+        if usage is not None and usage.total_tokens:
+            return tool_calls, usage.total_tokens
+        return tool_calls, sum(self.context_window.count(message) for message in fitted)
+
+    async def process_stream(self, response: AsyncStream[ChatCompletionChunk],
+                             ctx: AIContext) -> Tuple[List[ChoiceDeltaToolCall], CompletionUsage | None]:
+        """
+        Consume a streamed completion, forwarding text deltas to the context
+        and merging tool call deltas by their index.
+        """
+        tool_calls: Dict[int, ChoiceDeltaToolCall] = {}
+        usage = None
+        async for chunk in response:
+            if chunk.usage is not None:
+                usage = chunk.usage  # Already counted by the LLMClient stream
+            for choice in chunk.choices:
+                delta = choice.delta
+                if delta.content:
+                    ctx.stream_response(delta.content)
+                for tool_call in delta.tool_calls or []:
+                    if tool_call.index not in tool_calls:
+                        tool_call.function.arguments = tool_call.function.arguments or ""
+                        tool_calls[tool_call.index] = tool_call
+                    elif tool_call.function and tool_call.function.arguments:
+                        tool_calls[tool_call.index].function.arguments += tool_call.function.arguments
+        return [tool_calls[index] for index in sorted(tool_calls)], usage
+
     async def process_tool_calls(self, tool_calls: List[ChoiceDeltaToolCall],
-                                 messages: List[ChatCompletionMessageParam], ctx: AIContext):
+                                 messages: List[ChatCompletionMessageParam], ctx: AIContext, allowed: int,
+                                 timeout: Optional[float] = None):
+        """
+        Run the tool calls of one assistant turn and append their results.
+        Calls past `allowed` are answered as skipped and calls still running after
+        `timeout` seconds are cancelled, every call id still gets a result.
+        """
         messages.append({
             "role": "assistant",
-            "tool_calls": [tool.to_dict() for tool in tool_calls]
+            "tool_calls": [
+                {
+                    "id": tool.id,
+                    "type": "function",
+                    "function": {"name": tool.function.name, "arguments": tool.function.arguments}
+                } for tool in tool_calls
+            ]
         })
-        for tool_call in tool_calls:
-            fn = self.functions.get(tool_call.function.name)
-            if fn is None:
-                messages.append({
-                    "role": "tool",
-                    "content": f"Tool '{tool_call.function.name}' not found.",
-                    "tool_call_id": tool_call.id,
-                })
-                continue
-            args = json.loads(tool_call.function.arguments)
-            try:
-                result = await fn.call(ctx, **args)
-                print(f"Tool call: {tool_call.function.name} with args: {args}, result: {result}")
-            except Exception as e:
-                traceback.print_exc()
-                result = {"error": str(e)}
-                print(f"Tool call: {tool_call.function.name} with args: {args}, error: {e}")
+        contents = [None] * len(tool_calls)
+        semaphore = asyncio.Semaphore(self.tool_call_concurrency)
+
+        async def run(index: int):
+            async with semaphore:
+                contents[index] = await self.call_tool(tool_calls[index], ctx)
+
+        tasks = []
+
+        async def run_all():
+            pending = []
+            for index, tool_call in enumerate(tool_calls):
+                if index >= allowed:
+                    contents[index] = json.dumps({"error": "Skipped, the tool call budget for this request is used up."})
+                    continue
+                fn = self.functions.get(tool_call.function.name)
+                if getattr(fn, "serial", False):
+                    # Side effect tools act as a barrier between concurrent batches
+                    await asyncio.gather(*pending)
+                    pending = []
+                    await run(index)
+                else:
+                    pending.append(asyncio.create_task(run(index)))
+                    tasks.append(pending[-1])
+            await asyncio.gather(*pending)
+
+        try:
+            await asyncio.wait_for(run_all(), timeout)
+        except asyncio.TimeoutError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for index, content in enumerate(contents):
+            if content is None:
+                contents[index] = json.dumps({"error": "Cancelled, the time budget for this request is used up."})
+
+        for tool_call, content in zip(tool_calls, contents):
             messages.append({
                 "role": "tool",
-                "content": result if isinstance(result, list) else json.dumps(result),
+                "content": self.limit_tool_output(tool_call, content, ctx),
                 "tool_call_id": tool_call.id,
             })
-        return await self.process_response(messages, ctx)
+
+    def get_tool_output_limit(self, name: str) -> int:
+        if name in self.tool_output_limits:
+            return self.tool_output_limits[name]
+        max_output = getattr(self.functions.get(name), "max_output", None)
+        return self.tool_output_limit if max_output is None else max_output
+
+    def limit_tool_output(self, tool_call: ChoiceDeltaToolCall, content: str, ctx: AIContext):
+        """
+        Keep oversized tool results out of the conversation. The full output is stored
+        on the context and the model gets a preview it can page through or search.
+        """
+        limit = self.get_tool_output_limit(tool_call.function.name)
+        if limit <= 0 or len(content) <= limit:
+            return content
+        output_id = ctx.store_tool_output(tool_call.function.name, content)
+        return json.dumps({
+            "truncated": True,
+            "output_id": output_id,
+            "total_length": len(content),
+            "preview": content[:limit],
+            "reason": f"Output too long, only the first {limit} characters are shown. "
+                      f"Use read_tool_output from offset {limit} to read more or search_tool_output to find specific parts."
+        }, ensure_ascii=False)
+
+    def get_tool_semaphore(self, fn) -> asyncio.Semaphore | None:
+        if not getattr(fn, "concurrency", None):
+            return None
+        if fn.name not in self.tool_semaphores:
+            self.tool_semaphores[fn.name] = asyncio.Semaphore(fn.concurrency)
+        return self.tool_semaphores[fn.name]
+
+    async def call_tool(self, tool_call: ChoiceDeltaToolCall, ctx: AIContext):
+        fn = self.functions.get(tool_call.function.name)
+        if fn is None:
+            return f"Tool '{tool_call.function.name}' not found."
+        args = {}
+        try:
+            # Parse inside the try so one bad call does not abort its concurrent siblings
+            args = json.loads(tool_call.function.arguments)
+            async with self.get_tool_semaphore(fn) or contextlib.nullcontext():
+                result = await fn.call(ctx, **args)
+            print(f"Tool call: {tool_call.function.name} with args: {args}, result: {result}")
+        except Exception as e:
+            traceback.print_exc()
+            result = {"error": str(e)}
+            print(f"Tool call: {tool_call.function.name} with args: {args}, error: {e}")
+        return self.tool_result_text(result)
+
+    def tool_result_text(self, result) -> str:
+        """
+        Plain text of a tool result. MCP results are lists of content parts, their text
+        parts are joined and other parts are kept as JSON. Non ASCII is kept as is so
+        stored outputs can be searched and paged without cutting escapes apart.
+        """
+        if isinstance(result, str):
+            return result
+        if not isinstance(result, list):
+            return json.dumps(result, ensure_ascii=False, default=str)
+        parts = []
+        for part in result:
+            if isinstance(part, list):
+                parts.append(self.tool_result_text(part))
+            elif isinstance(part, dict) and part.get("type") == "text":
+                parts.append(part["text"])
+            else:
+                parts.append(json.dumps(part, ensure_ascii=False, default=str))
+        return "\n".join(parts)
 
     async def get_messages_history(self, message: discord.Message):
         messages = [{
             "role": "user",
             "content": await self.format_messages.format_user_message(message)
         }]
-        async for msg in message.channel.history(limit=10, before=message):
+        for msg in await self.history_cache.history(message, self.history_limit):
             if msg.author == self.user:
                 messages.append({
                     "role": "assistant",
@@ -171,12 +502,73 @@ class FClient(discord.Client):
 
     async def setup_hook(self) -> None:
         await self.load_modules()
-        self.functions.update(await self.mcp_manager.get_tools())
-        self.functions_json_schema.extend([f.to_dict() for f in self.functions.values()])
+        self.mcp_manager.start()
+        self.set_mcp_functions(await self.mcp_manager.get_tools())
+        self.mcp_manager.start_refresh(self.set_mcp_functions)
         self.load_google_search()  # Load Google Search client need event loop
+        self.stats_task = asyncio.create_task(self.report_stats())
+
+    def set_mcp_functions(self, mcp_functions: dict):
+        # Sorted so the tool schemas are byte identical whatever the load order
+        functions = dict(sorted({**self.module_functions, **mcp_functions}.items()))
+        # Swap both together so a request never sees a schema without its function
+        self.functions, self.functions_json_schema = functions, [f.to_dict() for f in functions.values()]
+
+    async def close(self) -> None:
+        if self.stats_task is not None:
+            self.stats_task.cancel()
+        for module in self.modules:
+            await module.close()
+        await self.mcp_manager.close()
+        await super().close()
+
+    def stats(self) -> dict:
+        llm = self.llm.stats()
+        scheduler = self.scheduler.stats()
+        return {
+            "cluster": self.cluster_id,
+            "shards": len(self.shards),
+            "guilds": len(self.guilds),
+            "latency": self.latency,
+            "active_requests": scheduler["active"],
+            "queued_requests": scheduler["queue_depth"],
+            "rejected_requests": scheduler["rejected"],
+            "llm_calls": llm["calls"],
+            "prompt_tokens": llm["prompt_tokens"],
+            "cached_prompt_tokens": llm["cached_prompt_tokens"],
+            "llm": llm,
+            "scheduler": scheduler,
+            "context_window": self.context_window.stats(),
+            "format_messages": self.format_messages.stats(),
+            "search": self.google_search_client.stats() if self.google_search_client else None,
+            "history_rest_fetches": self.history_cache.rest_fetches,
+            "document_cache": self.module_stats("document_cache"),
+            "embedding_cache": self.module_stats("embedding_cache"),
+            "converter": self.module_stats("converter")
+        }
+
+    def module_stats(self, name: str):
+        """Stats of the first module owning a `name` component, None when no module loaded it."""
+        for module in self.modules:
+            component = getattr(module, name, None)
+            if component is not None:
+                return component.stats()
+        return None
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            try:
+                if self.stats_queue is not None:
+                    self.stats_queue.put(("stats", self.cluster_id, self.stats()))
+                else:
+                    print(f"Stats: {self.stats()}")  # Single process, no launcher to aggregate them
+            except Exception as e:
+                print(f"Error reporting stats: {e}")
 
     async def add_module(self, module):
-        self.functions.update(module.functions)
+        self.modules.append(module)
+        self.module_functions.update(module.functions)
 
     async def load_modules(self):
         for filename in os.listdir("modules"):
@@ -218,6 +610,15 @@ class FClient(discord.Client):
         else:
             await interaction.response.defer()
         
+        guild_id = interaction.guild.id if interaction.guild else 0
+        try:
+            async with self.scheduler.admit(guild_id, interaction.user.id):
+                await self.process_component_interaction(interaction, original_message, is_button)
+        except SchedulerBusy:
+            await interaction.followup.send(BUSY_MESSAGE, ephemeral=True)
+
+    async def process_component_interaction(self, interaction: discord.Interaction,
+                                            original_message: discord.Message, is_button: bool):
         ctx = AIContext(original_message, self)
         
         ctx._response_message = await interaction.message.reply(view=ctx.typing_view())
@@ -237,7 +638,6 @@ class FClient(discord.Client):
                 selected_options = ",".join(interaction.data['values'])
                 message = f"User just select with id `{custom_id}` and selected options index: `{selected_options}` (0-based index where `,` is separator for multiple indexes)"
             messages = [
-                {"role": "system", "content": self.get_system_prompt(original_message)},
                 {"role": "user", "content": await self.format_messages.format_user_message(original_message)},
                 {"role": "assistant", "content": await self.format_messages.format_ai_message(interaction.message)},
                 {"role": "developer", "content": [
@@ -245,30 +645,56 @@ class FClient(discord.Client):
                     {"type": "text", "text": f"User info: {json.dumps(user_info)}"}
                 ]}
             ]
+            self.add_system_prompt(messages, original_message)
 
             await self.process_response(messages, ctx)
 
     async def on_message(self, message: discord.Message):
+        self.history_cache.add(message)
         if message.author.bot:
             return
 
         if self.user not in message.mentions:
             return
 
-        ctx = AIContext(message, self)
-        async with ctx:
-            messages = await self.get_messages_history(message)
-            messages.insert(0, {
-                "role": "system",
-                "content": self.get_system_prompt(message)
-            })
+        try:
+            async with self.scheduler.admit(message.guild.id if message.guild else 0, message.author.id):
+                ctx = AIContext(message, self)
+                async with ctx:
+                    messages = await self.get_messages_history(message)
+                    self.add_system_prompt(messages, message)
 
-            await self.process_response(messages, ctx)
+                    await self.process_response(messages, ctx)
+        except SchedulerBusy:
+            await message.reply(BUSY_MESSAGE, delete_after=30)
 
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState,
                                     after: discord.VoiceState):
         pass
         # TODO: MAKE VOICE STATE HANDLER FOR NEW FEATURES
 
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        self.history_cache.update(payload.message)
+        self.format_messages.invalidate(payload.message_id)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.history_cache.remove(payload.channel_id, [payload.message_id])
+        self.format_messages.invalidate(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        self.history_cache.remove(payload.channel_id, payload.message_ids)
+        for message_id in payload.message_ids:
+            self.format_messages.invalidate(message_id)
+
+    async def on_shard_ready(self, shard_id: int):
+        # New gateway session for this shard's guilds, events may have been missed while disconnected
+        guild_ids = {guild.id for guild in self.guilds if guild.shard_id == shard_id}
+        if shard_id == 0:
+            guild_ids.add(None)  # DMs are delivered on shard 0
+        self.history_cache.invalidate(guild_ids)
+        print(f'Shard {shard_id} ready')
+
     async def on_ready(self):
-        print(f'We have logged in as {self.user}')
+        print(f'We have logged in as {self.user} (cluster {self.cluster_id}, shards {sorted(self.shards)})')
+        if self.stats_queue is not None:
+            self.stats_queue.put(("ready", self.cluster_id, None))
@@ -1,9 +1,34 @@
+import bisect
+import os
 import re
-from typing import Union, List, Any, Optional
+from typing import Union, List, Any, Optional, Tuple, Dict, Set
 import discord
 from discord import ui
 from discord.ui import view
 from classs import FClient
+from classs.LRUCache import LRUCache
+
+
+def _compile_grammar(components: List[Tuple[str, str, Optional[str]]]):
+    """
+    Compile the component grammar once into a single alternation.
+    Closing tags come first so a closer is never read as an inline component,
+    the rest keep the list order which decides ties at the same position.
+    """
+    closers = {}
+    for name, start, end in components:
+        if end is not None:
+            closers[name] = re.match(r'\\\[/(\w+)/\\\]', end).group(1)
+    close_alternatives = [f"(?P<close_{kind}>\\[/{kind}/\\])" for kind in dict.fromkeys(closers.values())]
+    start_alternatives = [f"(?P<{name}>{start})" for name, start, end in components]
+    inline_alternatives = [f"(?P<{name}>{start})" for name, start, end in components if end is None]
+    return (
+        re.compile("|".join(close_alternatives + start_alternatives)),
+        re.compile("|".join(close_alternatives)),
+        re.compile("|".join(inline_alternatives)),
+        {name: re.compile(start) for name, start, _ in components},
+        closers
+    )
 
 
 class FormatMessages:
@@ -23,14 +48,89 @@ class FormatMessages:
         ("Button", r'\[([^\]]+)\]\(bts\|([^\|]+)\|([01])\)', None),
         ("Separator", r"\[#Separator#([12])\]", None)
     ]
+    TOKEN_REGEX, CLOSE_REGEX, INLINE_REGEX, START_REGEX, BLOCK_CLOSERS = _compile_grammar(COMPONENTS_REGEX)
 
 
     client: FClient
+    # (kind, message id) -> (edited_at, formatted content, replied message id)
+    cache: LRUCache[Tuple[str, int], Tuple[Any, Any, Optional[int]]]
+    CACHE_KINDS = ("ai", "user")
+    # replied message id -> cache keys of the messages embedding it
+    replies: Dict[int, Set[Tuple[str, int]]]
+    references: LRUCache[int, Optional[discord.Message]]
 
     def __init__(self, client: FClient):
         self.client = client
+        cache_size = int(os.getenv("FORMAT_CACHE_SIZE", "2048"))
+        self.cache = LRUCache(cache_size, on_evict=self._unindex)
+        self.replies = {}
+        self.references = LRUCache(cache_size)
+
+    def _unindex(self, key: Tuple[str, int], entry: Tuple[Any, Any, Optional[int]]):
+        keys = self.replies.get(entry[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.replies[entry[2]]
+
+    def _cache_set(self, kind: str, message: discord.Message, content: Any, reference_id: Optional[int] = None):
+        key = (kind, message.id)
+        self._cache_pop(key)
+        self.cache.set(key, (message.edited_at, content, reference_id))
+        if reference_id is not None:
+            self.replies.setdefault(reference_id, set()).add(key)
+
+    def _cache_pop(self, key: Tuple[str, int]):
+        entry = self.cache.pop(key)
+        if entry is not None:
+            self._unindex(key, entry)
+
+    def _cache_get(self, kind: str, message: discord.Message):
+        entry = self.cache.get((kind, message.id))
+        if entry is None:
+            return None
+        if entry[0] != message.edited_at:
+            self._cache_pop((kind, message.id))
+            return None
+        return entry[1]
+
+    def invalidate(self, message_id: int):
+        """
+        Drop cached formatting of an edited or deleted message and of every
+        message whose formatting embeds it as a reply.
+        """
+        self.references.pop(message_id)
+        for kind in self.CACHE_KINDS:
+            self._cache_pop((kind, message_id))
+        for key in list(self.replies.get(message_id, ())):
+            self._cache_pop(key)
+
+    def stats(self) -> dict:
+        return {"messages": self.cache.stats(), "references": self.references.stats()}
+
+    async def resolve_reference(self, message: discord.Message) -> Optional[discord.Message]:
+        reference_id = message.reference.message_id
+        if reference_id in self.references:
+            return self.references.get(reference_id)
+        reply_message = self.client.history_cache.get_message(message.channel.id, reference_id)
+        if reply_message is None and isinstance(message.reference.resolved, discord.Message):
+            reply_message = message.reference.resolved
+        if reply_message is None:
+            try:
+                reply_message = await message.channel.fetch_message(reference_id)
+            except discord.NotFound:
+                reply_message = None
+        self.references.set(reference_id, reply_message)
+        return reply_message
 
     async def format_ai_message(self, message: discord.Message) -> str:
+        content = self._cache_get("ai", message)
+        if content is None:
+            content = self._format_ai_message(message)
+            self._cache_set("ai", message, content)
+        return content
+
+    def _format_ai_message(self, message: discord.Message) -> str:
 
         if message.author.id != self.client.user.id:
             return message.content  # Not by us by other bot, return content only
@@ -104,107 +204,129 @@ class FormatMessages:
         return content
 
     def regex_chuck_component(self, text: str) -> List[Any]:
-        text_arr = []
-        text_left = text.strip()
-
-        while text_left:
-            best_match = None
-            best_name = None
-            best_end_pattern = None
-
-            for name, start_pattern, end_pattern in self.COMPONENTS_REGEX:
-                if end_pattern is not None:
-                    pattern = re.compile(f"{start_pattern}(.*?){end_pattern}", re.DOTALL)
-                else:
-                    pattern = re.compile(start_pattern, re.DOTALL)
-
-                match = pattern.search(text_left)
-                if match:
-                    if best_match is None or match.start() < best_match.start():
-                        best_match = match
-                        best_name = name
-                        best_end_pattern = end_pattern
-
-            if best_match:
-                start = best_match.start()
-                end = best_match.end()
-
-                if start > 0:
-                    pre_text = text_left[:start].strip()
-                    if pre_text:
-                        text_arr.append(pre_text)
-
-                sub_component, data = self.component_process_regex(
-                    best_name, best_match, best_end_pattern is not None
-                )
-
-                if best_end_pattern is not None:
-                    text_arr.append({"type": best_name, "component": sub_component, "data": data})
-                else:
-                    text_arr.append({"type": best_name, "data": data})
-
-                text_left = text_left[end:].strip()
-            else:
-                if text_left:
-                    text_arr.append(text_left)
+        """
+        Split text into plain text and component dicts in a single scan.
+        Blocks of different kinds nest through the recursion stack, a block whose
+        closing tag never comes is read as inline components or plain text instead.
+        """
+        text = text.strip()
+        closers: Dict[str, List[int]] = {}
+        for match in self.CLOSE_REGEX.finditer(text):
+            closers.setdefault(match.lastgroup[6:], []).append(match.start())
+        items, _, _ = self._scan(text, 0, None, (), closers)
+        return items
+
+    def _scan(self, text: str, pos: int, kind: Optional[str], open_kinds: Tuple[str, ...],
+              closers: Dict[str, List[int]]) -> Tuple[List[Any], int, Optional[int]]:
+        """
+        Scan from pos until the closing tag of `kind` (None for top level).
+        Return the items, the position after the closing tag and the body end,
+        body end is None when the block is not closed.
+        """
+        items = []
+        text_start = pos
+
+        def flush(until: int):
+            pre_text = text[text_start:until].strip()
+            if pre_text:
+                items.append(pre_text)
+
+        while True:
+            match = self.TOKEN_REGEX.search(text, pos)
+            if match is None:
                 break
-
-        return [x for x in text_arr if x]
-
-
-    def component_process_regex(self, name: str, content: re.Match, end: bool):
-        content_text = list(content.groups())[-1]
+            name = match.lastgroup
+            start = match.start()
+            if name.startswith("close_"):
+                close_kind = name[6:]
+                if close_kind == kind:
+                    flush(start)
+                    return items, match.end(), start
+                if close_kind in open_kinds:
+                    return items, start, None  # An outer block closes first, this one is unclosed
+                match = None
+            elif name in self.BLOCK_CLOSERS:
+                block_kind = self.BLOCK_CLOSERS[name]
+                positions = closers.get(block_kind, [])
+                # A block never nests inside a block of its own kind, the first closer ends the outer one
+                if (block_kind != kind and block_kind not in open_kinds
+                        and bisect.bisect_left(positions, match.end()) < len(positions)):
+                    children, after, body_end = self._scan(
+                        text, match.end(), block_kind, open_kinds + (kind,), closers
+                    )
+                    if body_end is not None:
+                        flush(start)
+                        groups = self.START_REGEX[name].match(text, start).groups()
+                        data = self._component_data(name, groups, text[match.end():body_end])
+                        items.append({"type": name, "component": children, "data": data})
+                        pos = text_start = after
+                        continue
+                match = None
+
+            if match is None:
+                # Rejected tag, it can still start an inline component or is plain text
+                match = self.INLINE_REGEX.match(text, start)
+                if match is None:
+                    pos = start + 1
+                    continue
+                name = match.lastgroup
+            flush(start)
+            groups = self.START_REGEX[name].match(text, start).groups()
+            items.append({"type": name, "data": self._component_data(name, groups, None)})
+            pos = text_start = match.end()
+
+        flush(len(text))
+        return items, len(text), None if kind is not None else len(text)
+
+    def _component_data(self, name: str, groups: Tuple[Optional[str], ...], body: Optional[str]) -> dict:
         data = {}
         if name == "SectionThumbnail":
             data = {
-                "description": content.group(1),
-                "url": content.group(2),
-                "spoiler": bool(int(content.group(3)))
+                "description": groups[0],
+                "url": groups[1],
+                "spoiler": bool(int(groups[2]))
             }
         elif name == "SectionButtonLink":
             data = {
-                "label": content.group(1),
-                "content": content.group(2)
+                "label": groups[0],
+                "content": groups[1]
             }
         elif name == "SectionButton":
             data = {
-                "label": content.group(1),
-                "disabled": bool(int(content.group(3))),
-                "content": content.group(4) if content.group(4) else None
+                "label": groups[0],
+                "disabled": bool(int(groups[2])),
+                "content": body if body else None
             }
         elif name == "MediaGalleryItem":
             data = {
-                "description": content.group(1),
-                "url": content.group(2),
-                "spoiler": bool(int(content.group(3)))
+                "description": groups[0],
+                "url": groups[1],
+                "spoiler": bool(int(groups[2]))
             }
         elif name == "ButtonLink":
             data = {
-                "label": content.group(1),
-                "url": content.group(2)
+                "label": groups[0],
+                "url": groups[1]
             }
         elif name == "Button":
             data = {
-                "label": content.group(1),
-                "style": content.group(2),
-                "disabled": bool(int(content.group(3)))
+                "label": groups[0],
+                "style": groups[1],
+                "disabled": bool(int(groups[2]))
             }
         elif name == "Select":
             data = {
-                "placeholder": content.group(1),
-                "options": content.group(2).split(',') if content.group(2) else [],
-                "min": int(content.group(3)),
-                "max": int(content.group(4)),
-                "disabled": bool(int(content.group(5)))
+                "placeholder": groups[0],
+                "options": groups[1].split(',') if groups[1] else [],
+                "min": int(groups[2]),
+                "max": int(groups[3]),
+                "disabled": bool(int(groups[4]))
             }
         elif name == "Separator":
             data = {
-                "size": int(content.group(1)) if content.group(1) else 1
+                "size": int(groups[0]) if groups[0] else 1
             }
-        if end:
-            return self.regex_chuck_component(content_text), data
-        else:
-            return None, data
+        return data
 
     def text_to_component(self, text: str) -> ui.LayoutView:
         view = ui.LayoutView(timeout=1)
@@ -213,6 +335,9 @@ class FormatMessages:
             view.add_item(self.component_process(component))
         return view
 
+    def create_stream_parser(self) -> "ComponentStreamParser":
+        return ComponentStreamParser(self)
+
     def component_process(self, component: Union[str, dict]) -> Optional[Union[ui.Item, discord.MediaGalleryItem]]:
         data = component["data"] if isinstance(component, dict) else {}
         if isinstance(component, str):
@@ -291,6 +416,14 @@ class FormatMessages:
 
 
     async def format_user_message(self, message: discord.Message) -> list[dict]:
+        content = self._cache_get("user", message)
+        if content is None:
+            content = await self._format_user_message(message)
+            reference_id = message.reference.message_id if message.reference else None
+            self._cache_set("user", message, content, reference_id)
+        return [dict(block) for block in content]  # Callers must not mutate cached blocks
+
+    async def _format_user_message(self, message: discord.Message) -> list[dict]:
         context = {
             "User ID": message.author.id,
             "Username": message.author.name,
@@ -301,21 +434,136 @@ class FormatMessages:
             if message.author.nick:
                 context["User Nickname"] = message.author.nick
         if message.reference:
-            try:
-                reply_message = await message.channel.fetch_message(message.reference.message_id)
-                if reply_message.author.id == self.client.user.id:
-                    context["Reply Your Message ID"] = reply_message.id
-                    context["Reply To Your Message Content"] = await self.format_ai_message(reply_message)
-                else:
-                    context["Message Reply To Message ID"] = message.reference.message_id
-                    context["Message Reply To Author"] = reply_message.author.name
-                    context["Message Reply To Author ID"] = reply_message.author.id
-                    context["Message Reply To Content"] = reply_message.content or "Empty Content"
-            except discord.NotFound:
+            reply_message = await self.resolve_reference(message)
+            if reply_message is None:
                 pass
+            elif reply_message.author.id == self.client.user.id:
+                context["Reply Your Message ID"] = reply_message.id
+                context["Reply To Your Message Content"] = await self.format_ai_message(reply_message)
+            else:
+                context["Message Reply To Message ID"] = message.reference.message_id
+                context["Message Reply To Author"] = reply_message.author.name
+                context["Message Reply To Author ID"] = reply_message.author.id
+                context["Message Reply To Content"] = reply_message.content or "Empty Content"
         context_string = "# User Message Context (Context for You)\n\n"
         context_string += '\n'.join([f'{k}: {v}' for k, v in context.items()])
         return [
             {"type": "text", "text": message.content},
             {"type": "text", "text": context_string}
-        ]
\ No newline at end of file
+        ]
+
+
+class StreamFrame:
+    name: Optional[str]
+    kind: Optional[str]
+    open_start: int
+    body_start: int
+    items: List[Any]
+
+    def __init__(self, name: Optional[str], kind: Optional[str], open_start: int, body_start: int):
+        self.name = name
+        self.kind = kind
+        self.open_start = open_start
+        self.body_start = body_start
+        self.items = []
+
+
+class ComponentStreamParser:
+    """
+    Incremental component parser for streamed responses.
+    Text is appended with `feed`, `snapshot` scans only what arrived since the
+    last closed token and renders a LayoutView of everything parsed so far.
+    Unclosed blocks render as plain text, except a Container which renders
+    with its children parsed so far.
+    """
+    formatter: FormatMessages
+    stack: List[StreamFrame]
+
+    def __init__(self, formatter: FormatMessages):
+        self.formatter = formatter
+        self.text = ""
+        self.pos = 0
+        self.text_start = 0
+        self.stack = [StreamFrame(None, None, 0, 0)]
+
+    def feed(self, chunk: str):
+        self.text += chunk
+
+    def _flush(self, until: int):
+        pre_text = self.text[self.text_start:until].strip()
+        if pre_text:
+            self.stack[-1].items.append(pre_text)
+
+    def _advance(self):
+        text = self.text
+        while True:
+            match = FormatMessages.TOKEN_REGEX.search(text, self.pos)
+            if match is None:
+                return
+            name = match.lastgroup
+            start = match.start()
+            open_kinds = [frame.kind for frame in self.stack]
+            if name.startswith("close_"):
+                close_kind = name[6:]
+                if close_kind == self.stack[-1].kind:
+                    self._flush(start)
+                    frame = self.stack.pop()
+                    groups = FormatMessages.START_REGEX[frame.name].match(text, frame.open_start).groups()
+                    data = self.formatter._component_data(frame.name, groups, text[frame.body_start:start])
+                    self.stack[-1].items.append({"type": frame.name, "component": frame.items, "data": data})
+                    self.pos = self.text_start = match.end()
+                    continue
+                if close_kind in open_kinds:
+                    # An outer block closes first, inner unclosed blocks become plain text
+                    while self.stack[-1].kind != close_kind:
+                        frame = self.stack.pop()
+                        self.text_start = frame.open_start
+                    self.pos = start
+                    continue
+                match = None
+            elif name in FormatMessages.BLOCK_CLOSERS:
+                block_kind = FormatMessages.BLOCK_CLOSERS[name]
+                if block_kind not in open_kinds:
+                    self._flush(start)
+                    self.stack.append(StreamFrame(name, block_kind, start, match.end()))
+                    self.pos = self.text_start = match.end()
+                    continue
+                match = None
+
+            if match is None:
+                match = FormatMessages.INLINE_REGEX.match(text, start)
+                if match is None:
+                    self.pos = start + 1
+                    continue
+                name = match.lastgroup
+            self._flush(start)
+            groups = FormatMessages.START_REGEX[name].match(text, start).groups()
+            self.stack[-1].items.append({"type": name, "data": self.formatter._component_data(name, groups, None)})
+            self.pos = self.text_start = match.end()
+
+    def _open_items(self, index: int) -> List[Any]:
+        frame = self.stack[index]
+        items = list(frame.items)
+        if index + 1 < len(self.stack):
+            child = self.stack[index + 1]
+            if child.name == "Container":
+                items.append({"type": "Container", "component": self._open_items(index + 1), "data": {}})
+            else:
+                raw_text = self.text[child.open_start:].strip()
+                if raw_text:
+                    items.append(raw_text)
+        else:
+            tail = self.text[self.text_start:].strip()
+            if tail:
+                items.append(tail)
+        return items
+
+    def items(self) -> List[Any]:
+        self._advance()
+        return self._open_items(0)
+
+    def snapshot(self) -> ui.LayoutView:
+        view = ui.LayoutView(timeout=1)
+        for component in self.items():
+            view.add_item(self.formatter.component_process(component))
+        return view
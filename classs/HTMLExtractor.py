@@ -0,0 +1,209 @@
+import re
+from html.parser import HTMLParser
+from typing import List, Optional
+
+SKIP_TAGS = {
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe", "object",
+    "nav", "footer", "header", "aside", "form", "button", "select", "dialog"
+}
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "dl", "dt", "dd", "figure",
+    "figcaption", "address", "details", "summary", "body", "html"
+}
+HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+VOID_TAGS = {"br", "hr", "img", "input", "meta", "link", "source", "wbr", "area", "base", "col", "embed", "track"}
+INDENT = "\x01"  # Placeholder for list indentation, survives whitespace cleanup
+CONTENT_ROOTS = {"main", "article"}
+ROOT_MIN_SHARE = 0.2  # Below this share of the page text a <main>/<article> is a side card, not the content
+
+
+class HTMLExtractor(HTMLParser):
+    """
+    Small HTML to markdown extractor for ordinary web pages.
+    Drops scripts, styles and page chrome (nav, header, footer, aside, forms),
+    keeps only <main>/<article> when they hold most of the page text and renders headings,
+    paragraphs, lists, links, emphasis, code, quotes and plain tables.
+    Pages it cannot render faithfully (nested tables) are reported as complex.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root_depth = 0
+        self.skip_stack: List[str] = []
+        self.out: List[str] = []
+        self.root_out: List[str] = []  # Text inside content roots
+        self.links: List[Optional[str]] = []
+        self.lists: List[List] = []  # [tag, counter]
+        self.pre = 0
+        self.quote = 0
+        self.table: Optional[List[List[str]]] = None
+        self.cell: Optional[List[str]] = None
+        self.complex = False
+
+    @classmethod
+    def extract(cls, html: str) -> Optional[str]:
+        """Return markdown for the page, or None when it should go through the full converter."""
+        parser = cls()
+        parser.feed(html)
+        parser.close()
+        if parser.complex:
+            return None
+        markdown = parser.markdown(parser.out)
+        root = parser.markdown(parser.root_out)
+        if root and len(root) >= ROOT_MIN_SHARE * len(markdown):
+            return root
+        return markdown or None
+
+    def write(self, text: str):
+        if self.skip_stack:
+            return
+        if self.cell is not None:
+            self.cell.append(text)
+            return
+        self.out.append(text)
+        if self.root_depth > 0:
+            self.root_out.append(text)
+
+    def block(self, prefix: str = ""):
+        if self.cell is not None:
+            self.write(" ")
+            return
+        quote = "> " * self.quote
+        self.write("\n\n" + quote + prefix)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in CONTENT_ROOTS:
+            self.root_depth += 1
+        if tag in SKIP_TAGS:
+            self.skip_stack.append(tag)
+            return
+        if self.skip_stack:
+            return
+        attrs = dict(attrs)
+        if tag in HEADINGS:
+            self.block("#" * HEADINGS[tag] + " ")
+        elif tag in BLOCK_TAGS:
+            self.block()
+        elif tag == "li":
+            indent = INDENT * max(0, len(self.lists) - 1)
+            if self.lists and self.lists[-1][0] == "ol":
+                self.lists[-1][1] += 1
+                marker = f"{self.lists[-1][1]}. "
+            else:
+                marker = "- "
+            self.write("\n" + "> " * self.quote + indent + marker)
+        elif tag in ("ul", "ol"):
+            if not self.lists:
+                self.block()
+            self.lists.append([tag, 0])
+        elif tag == "blockquote":
+            self.quote += 1
+            self.block()
+        elif tag == "pre":
+            self.pre += 1
+            self.block("```\n")
+        elif tag == "code" and not self.pre:
+            self.write("`")
+        elif tag in ("strong", "b"):
+            self.write("**")
+        elif tag in ("em", "i"):
+            self.write("*")
+        elif tag == "a":
+            href = attrs.get("href")
+            if href and not href.startswith(("#", "javascript:")):
+                self.links.append(href)
+                self.write("[")
+            else:
+                self.links.append(None)
+        elif tag == "br":
+            self.write("\n")
+        elif tag == "hr":
+            self.block("---")
+        elif tag == "img":
+            alt = (attrs.get("alt") or "").strip()
+            if alt:
+                self.write(alt)
+        elif tag == "table":
+            if self.table is not None:
+                self.complex = True
+            self.table = []
+        elif tag == "tr" and self.table is not None:
+            self.table.append([])
+        elif tag in ("td", "th") and self.table is not None:
+            self.cell = []
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in CONTENT_ROOTS and self.root_depth > 0:
+            self.root_depth -= 1
+        if tag in SKIP_TAGS:
+            if tag in self.skip_stack:
+                while self.skip_stack.pop() != tag:
+                    pass
+            return
+        if self.skip_stack:
+            return
+        if tag in HEADINGS or tag in BLOCK_TAGS:
+            self.block()
+        elif tag in ("ul", "ol"):
+            if self.lists:
+                self.lists.pop()
+            if not self.lists:
+                self.block()
+        elif tag == "blockquote":
+            self.quote = max(0, self.quote - 1)
+            self.block()
+        elif tag == "pre":
+            self.pre = max(0, self.pre - 1)
+            self.write("\n```")
+            self.block()
+        elif tag == "code" and not self.pre:
+            self.write("`")
+        elif tag in ("strong", "b"):
+            self.write("**")
+        elif tag in ("em", "i"):
+            self.write("*")
+        elif tag == "a" and self.links:
+            href = self.links.pop()
+            if href is not None:
+                self.write(f"]({href})")
+        elif tag in ("td", "th") and self.cell is not None and self.table:
+            self.table[-1].append(" ".join("".join(self.cell).split()).replace("|", "\\|"))
+            self.cell = None
+        elif tag == "table" and self.table is not None:
+            rows = [row for row in self.table if row]
+            self.table = None
+            self.cell = None
+            if rows:
+                width = max(len(row) for row in rows)
+                rows = [row + [""] * (width - len(row)) for row in rows]
+                lines = ["| " + " | ".join(row) + " |" for row in rows]
+                lines.insert(1, "|" + " --- |" * width)
+                self.block("\n".join(lines))
+                self.block()
+
+    def handle_data(self, data):
+        if self.pre:
+            self.write(data)
+        else:
+            self.write(re.sub(r"\s+", " ", data))
+
+    @staticmethod
+    def markdown(out: List[str]) -> str:
+        text = "".join(out)
+        lines = []
+        in_code = False
+        for line in text.split("\n"):
+            if line.lstrip("> ").startswith("```"):
+                in_code = not in_code
+            if not in_code:
+                line = re.sub(r" {2,}", " ", line.strip()).replace(INDENT, "  ")
+                if line.strip("> ") == "" and line:
+                    continue  # Empty quote line left between quoted blocks
+            lines.append(line.rstrip())
+        text = "\n".join(lines)
+        return re.sub(r"\n{3,}", "\n\n", text).strip()
@@ -0,0 +1,130 @@
+from collections import deque
+from typing import Deque, List, Iterable, Optional, Set
+
+import discord
+
+from classs.LRUCache import LRUCache
+
+
+class ChannelHistory:
+    messages: Deque[discord.Message]
+    warm: bool  # Buffer is contiguous with the channel, safe to serve history from
+    complete: bool  # Buffer reaches back to the first message of the channel
+
+    def __init__(self, size: int, guild_id: Optional[int]):
+        self.messages = deque(maxlen=size)
+        self.guild_id = guild_id
+        self.warm = False
+        self.complete = False
+
+    def add(self, message: discord.Message):
+        if not self.messages or message.id > self.messages[-1].id:
+            self.messages.append(message)
+            return
+        if any(m.id == message.id for m in self.messages):
+            return
+        # Out of order delivery, rebuild in snowflake order
+        ordered = sorted([*self.messages, message], key=lambda m: m.id)
+        self.messages.clear()
+        self.messages.extend(ordered[-self.messages.maxlen:])
+
+    def replace(self, message: discord.Message) -> bool:
+        for index, cached in enumerate(self.messages):
+            if cached.id == message.id:
+                self.messages[index] = message
+                return True
+        return False
+
+    def remove(self, message_ids: Iterable[int]):
+        message_ids = set(message_ids)
+        kept = [m for m in self.messages if m.id not in message_ids]
+        if len(kept) != len(self.messages):
+            self.messages.clear()
+            self.messages.extend(kept)
+
+
+class HistoryCache:
+    """
+    Per-channel ring buffer of recent messages fed by gateway events.
+    History for a warm channel is served from memory, a cold channel falls back
+    to a single REST call which then seeds the buffer. Only channels whose
+    history has been read are buffered, so busy channels the bot never
+    answers in do not push out the ones it does.
+    """
+    channels: LRUCache[int, ChannelHistory]
+
+    def __init__(self, size: int, max_channels: int):
+        self.size = size
+        self.channels = LRUCache(max_channels)
+        self.rest_fetches = 0
+
+    def _channel(self, message: discord.Message) -> ChannelHistory:
+        channel = self.channels.peek(message.channel.id)
+        if channel is None:
+            channel = ChannelHistory(self.size, message.guild.id if message.guild else None)
+            self.channels.set(message.channel.id, channel)
+        return channel
+
+    def add(self, message: discord.Message):
+        channel = self.channels.peek(message.channel.id)
+        if channel is not None:
+            channel.add(message)
+
+    def update(self, message: discord.Message):
+        channel = self.channels.peek(message.channel.id)
+        if channel is not None:
+            channel.replace(message)
+
+    def remove(self, channel_id: int, message_ids: Iterable[int]):
+        channel = self.channels.peek(channel_id)
+        if channel is not None:
+            channel.remove(message_ids)
+
+    def get_message(self, channel_id: int, message_id: int) -> Optional[discord.Message]:
+        channel = self.channels.peek(channel_id)
+        if channel is None:
+            return None
+        for message in channel.messages:
+            if message.id == message_id:
+                return message
+        return None
+
+    def invalidate(self, guild_ids: Optional[Set[Optional[int]]] = None):
+        """
+        Mark channels cold, used after a new gateway session where events may
+        have been missed. Only channels of `guild_ids` when given, None stands for DMs.
+        """
+        for channel in self.channels.values():
+            if guild_ids is not None and channel.guild_id not in guild_ids:
+                continue
+            channel.warm = False
+            channel.complete = False
+
+    async def history(self, message: discord.Message, limit: int) -> List[discord.Message]:
+        """
+        Return up to `limit` messages before `message`, newest first like
+        `channel.history`.
+        """
+        channel = self.channels.get(message.channel.id)
+        if channel is not None and channel.warm:
+            before = [m for m in channel.messages if m.id < message.id]
+            if len(before) >= limit or channel.complete:
+                return before[::-1][:limit]
+
+        # Buffer before the fetch so the request and messages arriving meanwhile are kept
+        channel = self._channel(message)
+        channel.add(message)
+        self.rest_fetches += 1
+        fetched = [m async for m in message.channel.history(limit=limit, before=message)]
+        self.channels.set(message.channel.id, channel)  # Back in case it was evicted during the fetch
+        kept = list(channel.messages)
+        if len(fetched) >= limit:
+            # Older buffered messages may have a gap before the fetched window
+            kept = [m for m in kept if m.id >= fetched[-1].id]
+        merged = {m.id: m for m in fetched}
+        merged.update({m.id: m for m in kept})  # Gateway copies are the most recent
+        channel.messages.clear()
+        channel.messages.extend(sorted(merged.values(), key=lambda m: m.id))
+        channel.complete = len(fetched) < limit
+        channel.warm = True
+        return fetched
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Any, Mapping, Optional
+
+import openai
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse rate limit reset values like "20ms", "1s", "6m0s" or plain seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    """
+    Per minute budget refilled continuously. A capacity of 0 means the limit is
+    unknown and nothing is throttled until the provider reports one.
+    `share` is the fraction of the limit this process may use when several
+    processes send with the same key.
+    """
+
+    def __init__(self, capacity: float, share: float = 1.0):
+        self.share = share
+        self.capacity = capacity * share
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self._refill()
+            self.tokens -= amount
+
+    def update(self, limit: Optional[str], remaining: Optional[str]):
+        """Sync with x-ratelimit-limit-* and x-ratelimit-remaining-* response headers."""
+        self._refill()
+        if limit and limit.isdigit():
+            if self.capacity <= 0:
+                self.tokens = float(limit) * self.share  # First limit learned, start full
+            self.capacity = float(limit) * self.share
+        if remaining and remaining.isdigit() and self.capacity > 0:
+            self.tokens = min(self.tokens, float(remaining) * self.share)
+
+    def utilization(self) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, 1 - self.tokens / self.capacity)
+
+
+class UsageStream:
+    """
+    Passes a completion stream through and settles the token estimate of the
+    call once the final chunk reports usage.
+    """
+
+    def __init__(self, stream: Any, client: "LLMClient", estimated: int):
+        self.stream = stream
+        self.client = client
+        self.estimated = estimated
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.stream, name)
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            if getattr(chunk, "usage", None) is not None:
+                self.client.settle_usage(chunk.usage, self.estimated)
+            yield chunk
+
+
+class LLMClient:
+    """
+    Chat completion calls with client side rate limiting.
+    Requests and tokens per minute are tracked in token buckets synced from the
+    x-ratelimit-* headers, calls wait before they would exceed a budget and
+    429 / 5xx / connection errors are retried with jittered exponential backoff
+    that honors Retry-After. With `share` below 1 the limits are split with
+    other processes using the same key and this one only uses its share.
+    """
+
+    def __init__(self, client: AsyncAzureOpenAI | AsyncOpenAI, rpm: int, tpm: int,
+                 max_retries: int, max_backoff: float, completion_tokens: int, share: float = 1.0):
+        self.client = client
+        self.requests = TokenBucket(rpm, share)
+        self.tokens = TokenBucket(tpm, share)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.completion_tokens = completion_tokens
+        self.paused_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._lock = asyncio.Lock()
+
+    def estimate_tokens(self, kwargs: dict) -> int:
+        """Rough prompt size (4 characters per token) plus the expected completion."""
+        prompt = len(json.dumps(kwargs.get("messages", []), default=str))
+        prompt += len(json.dumps(kwargs.get("tools", []), default=str))
+        completion = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or self.completion_tokens
+        return prompt // 4 + completion
+
+    async def _reserve(self, tokens: int):
+        # One waiter at a time keeps callers in arrival order
+        async with self._lock:
+            while True:
+                wait = max(
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(tokens),
+                    self.paused_until - time.monotonic()
+                )
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    return
+                self.wait_seconds += wait
+                await asyncio.sleep(wait)
+
+    def _update_limits(self, headers: Mapping[str, str]):
+        self.requests.update(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"))
+        self.tokens.update(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"))
+
+    def _retry_delay(self, attempt: int, headers: Optional[Mapping[str, str]]) -> float:
+        backoff = random.uniform(0, min(self.max_backoff, 2 ** attempt))
+        if headers is None:
+            return backoff
+        retry_after = None
+        if headers.get("retry-after-ms"):
+            retry_after = parse_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else None
+        if retry_after is None:
+            retry_after = parse_duration(headers.get("retry-after"))
+        if retry_after is None:
+            retry_after = max(
+                parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0
+            ) or None
+        if retry_after is None:
+            return backoff
+        return min(self.max_backoff, retry_after) + backoff * 0.1
+
+    async def create(self, **kwargs) -> Any:
+        """
+        Same arguments and result as `chat.completions.create`, streams included.
+        Streams only correct the token estimate when they are requested with
+        `stream_options={"include_usage": True}`.
+        """
+        estimated = self.estimate_tokens(kwargs)
+        attempt = 0
+        while True:
+            await self._reserve(estimated)
+            self.calls += 1
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                response = getattr(e, "response", None)
+                headers = response.headers if response is not None else None
+                if headers is not None:
+                    self._update_limits(headers)
+                if isinstance(e, openai.RateLimitError):
+                    self.throttled += 1
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, headers)
+                if isinstance(e, openai.RateLimitError):
+                    # Hold every caller, not just this one, until the provider accepts calls again
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                attempt += 1
+                self.retries += 1
+                print(f"LLM call failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            self._update_limits(raw.headers)
+            response = raw.parse()
+            if kwargs.get("stream"):
+                return UsageStream(response, self, estimated)
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                self.settle_usage(usage, estimated)
+            return response
+
+    def settle_usage(self, usage: Any, estimated: int):
+        self.record_usage(usage)
+        if usage.total_tokens:
+            # Give back or charge the difference between the estimate and real usage
+            self.tokens.take(usage.total_tokens - estimated)
+
+    def record_usage(self, usage: Any):
+        """Count prompt tokens and how many of them the provider served from its prompt cache."""
+        self.prompt_tokens += usage.prompt_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_tokens += getattr(details, "cached_tokens", None) or 0
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "wait_seconds": self.wait_seconds,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_tokens,
+            "prompt_cache_hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+            "requests_utilization": self.requests.utilization(),
+            "tokens_utilization": self.tokens.utilization()
+        }
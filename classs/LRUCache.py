@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from typing import Generic, TypeVar, Hashable, Optional, Dict, Any, Callable
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A bounded mapping that evicts the least recently used entry.
+    Keeps hit and miss counters for cache metrics.
+    `on_evict` is called with each entry pushed out by the size limit.
+    """
+    data: "OrderedDict[K, V]"
+
+    def __init__(self, max_size: int, on_evict: Optional[Callable[[K, V], None]] = None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """Get without touching recency or counters."""
+        return self.data.get(key, default)
+
+    def set(self, key: K, value: V):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            evicted = self.data.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(*evicted)
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def values(self):
+        return self.data.values()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -1,12 +1,20 @@
+import asyncio
+import datetime
+import json
 import os
+import random
 import traceback
-from typing import Dict, Any, List
+from typing import Dict, List, Callable
+import anyio
 from mcp import ClientSession, Tool
 from mcp.client.sse import sse_client
-from contextlib import AsyncExitStack
+from contextlib import asynccontextmanager
 from classs.AIContext import AIContext
 
 
+SNAPSHOT_FIELDS = {"name", "description", "inputSchema", "annotations"}
+
+
 class MCPFunction:
     name: str
 
@@ -15,6 +23,15 @@ class MCPFunction:
         self.description = tool.description
         self.inputSchema = tool.inputSchema
         self.client_name = client_name
+        annotations = getattr(tool, "annotations", None)
+        # Tools not declared read-only may have side effects, run them one at a time
+        self.serial = not (annotations is not None and annotations.readOnlyHint)
+        if self.name in os.getenv("MCPTOOL_CONCURRENT", "").replace(" ", "").split(","):
+            self.serial = False
+        elif self.name in os.getenv("MCPTOOL_SERIAL", "").replace(" ", "").split(","):
+            self.serial = True
+        self.concurrency = None
+        self.max_output = None
 
     def to_dict(self):
         parameters = self.inputSchema.copy()
@@ -32,7 +49,7 @@ class MCPFunction:
         """
         Call the function with the given context and arguments.
         """
-        data = await ctx.mcp_session.call_tool(self, kwargs)
+        data = await ctx.client.mcp_manager.call_tool(self, kwargs)
         raw_data = data.model_dump()
         content = []
         for message in raw_data["content"]:
@@ -51,11 +68,124 @@ class MCPFunction:
         return content
 
 
+class MCPConnection:
+    """
+    A persistent ClientSession to one MCP host.
+    The SSE stream is owned by a background task because anyio contexts must be
+    entered and exited in the same task, borrowers only get the live session.
+    """
+    session: ClientSession | None
+    # Errors that mean the stream is gone rather than the tool failing
+    CONNECTION_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream,
+                         ConnectionError, asyncio.TimeoutError)
+
+    def __init__(self, name: str, url: str, max_in_flight: int, health_interval: float):
+        self.name = name
+        self.url = url
+        self.health_interval = health_interval
+        self.session = None
+        self.in_flight = 0
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.ready = asyncio.Event()
+        self.broken = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        backoff = 1
+        while True:
+            try:
+                async with sse_client(url=self.url) as (read, write):
+                    async with ClientSession(read, write) as session:
+                        await session.initialize()
+                        self.session = session
+                        self.ready.set()
+                        backoff = 1
+                        print(f"MCP connection to {self.name} established")
+                        await self._health_check(session)
+            except Exception as e:
+                print(f"MCP connection to {self.name} lost: {e!r}")
+            finally:
+                self.ready.clear()
+                self.session = None
+            await asyncio.sleep(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, 60)
+
+    async def _health_check(self, session: ClientSession):
+        while True:
+            try:
+                await asyncio.wait_for(self.broken.wait(), timeout=self.health_interval)
+                self.broken.clear()
+                return  # A borrower hit a connection error, reconnect
+            except asyncio.TimeoutError:
+                await asyncio.wait_for(session.send_ping(), timeout=self.health_interval)
+
+    @asynccontextmanager
+    async def borrow(self, timeout: float):
+        self.start()
+        async with self.slots:
+            await asyncio.wait_for(self.ready.wait(), timeout=timeout)
+            self.in_flight += 1
+            try:
+                yield self.session
+            except self.CONNECTION_ERRORS:
+                self.broken.set()
+                raise
+            finally:
+                self.in_flight -= 1
+
+
+class MCPPool:
+    """
+    Persistent connections to one MCP host, tool calls borrow the least busy one.
+    """
+    connections: List[MCPConnection]
+
+    def __init__(self, name: str, url: str):
+        size = int(os.getenv("MCPPOOL_SIZE", "1"))
+        max_in_flight = int(os.getenv("MCPPOOL_MAX_IN_FLIGHT", "8"))
+        health_interval = float(os.getenv("MCPPOOL_HEALTH_INTERVAL", "30"))
+        self.connect_timeout = float(os.getenv("MCPPOOL_CONNECT_TIMEOUT", "15"))
+        self.connections = [
+            MCPConnection(name, url, max_in_flight, health_interval) for _ in range(size)
+        ]
+
+    def start(self):
+        for connection in self.connections:
+            connection.start()
+
+    async def close(self):
+        await asyncio.gather(*[connection.close() for connection in self.connections])
+
+    def borrow(self):
+        ready = [c for c in self.connections if c.ready.is_set()] or self.connections
+        connection = min(ready, key=lambda c: c.in_flight)
+        return connection.borrow(self.connect_timeout)
+
+
 class MCPManager:
     mcp_host: Dict[str, str] = {}
+    pools: Dict[str, MCPPool]
+    catalog: Dict[str, List[Tool]]
 
     def __init__(self):
         self.mcp_host = {}
+        self.pools = {}
+        self.catalog = {}
+        self.refresh_task = None
         for k, v in os.environ.items():
             if not k.startswith("MCP_"):
                 continue
@@ -66,68 +196,141 @@ class MCPManager:
                 raise EnvironmentError(
                     f"Duplicate MCP connection name: {name}. Please check your environment variables."
                 )
+        self.call_timeout = datetime.timedelta(seconds=float(os.getenv("MCPPOOL_CALL_TIMEOUT", "120")))
+        self.discovery_timeout = float(os.getenv("MCPCATALOG_TIMEOUT", "10"))
+        self.refresh_interval = float(os.getenv("MCPCATALOG_REFRESH_INTERVAL", "300"))
+        self.snapshot_path = os.getenv("MCPCATALOG_SNAPSHOT", "cache/mcp_catalog.json")
 
-    async def get_tools(self) -> Dict[str, MCPFunction]:
+    def get_pool(self, name: str) -> MCPPool:
+        if name not in self.pools:
+            self.pools[name] = MCPPool(name, self.mcp_host[name])
+        return self.pools[name]
+
+    def start(self):
+        """
+        Open the persistent connections of every host in the background.
+        """
+        for name in self.mcp_host:
+            self.get_pool(name).start()
+
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        await asyncio.gather(*[pool.close() for pool in self.pools.values()])
+
+    async def get_host_tools(self, name: str) -> List[Tool]:
+        async with self.get_pool(name).borrow() as session:
+            tool_list = await session.list_tools()
+        return tool_list.tools
+
+    async def discover(self) -> Dict[str, List[Tool]]:
+        """
+        List tools of every host concurrently.
+        Hosts that fail or exceed MCPCATALOG_TIMEOUT keep their last-known tools.
+        """
+        names = list(self.mcp_host)
+        results = await asyncio.gather(*[
+            asyncio.wait_for(self.get_host_tools(name), timeout=self.discovery_timeout) for name in names
+        ], return_exceptions=True)
+        catalog = {}
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to load functions from {name}: {result!r}")
+                if name in self.catalog:
+                    catalog[name] = self.catalog[name]
+                continue
+            catalog[name] = result
+            print(f"Loaded {len(result)} functions from {name}")
+        return catalog
+
+    def build_functions(self, catalog: Dict[str, List[Tool]]) -> Dict[str, MCPFunction]:
         functions = {}
-        for name, url in self.mcp_host.items():
-            stream_client = sse_client(
-                url=url
-            )
-            try:
-                async with stream_client as (read, write):
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        tool_list = await session.list_tools()
-                        for tool in tool_list.tools:
-                            if tool.name in functions:
-                                raise EnvironmentError(
-                                    f"Duplicate function name: {tool.name} host {name}. Please check your environment variables."
-                                )
-                            functions[tool.name] = MCPFunction(tool, name)
-                print(f"Loaded {len(functions)} functions from {name}")
-            except Exception:
-                traceback.print_exc()
+        for name, tools in catalog.items():
+            for tool in tools:
+                if tool.name in functions:
+                    print(f"Duplicate function name: {tool.name} host {name}. Please check your environment variables.")
+                    continue
+                functions[tool.name] = MCPFunction(tool, name)
         return functions
 
-    def create_session(self):
+    def load_snapshot(self) -> Dict[str, List[Tool]]:
+        try:
+            with open(self.snapshot_path, "r", encoding="utf8") as f:
+                raw = json.load(f)
+            return {
+                name: [Tool.model_validate(tool) for tool in tools]
+                for name, tools in raw.items() if name in self.mcp_host
+            }
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            traceback.print_exc()
+            return {}
+
+    def save_snapshot(self, catalog: Dict[str, List[Tool]]):
+        raw = self._catalog_raw(catalog)
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+            temp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"  # Cluster processes may save at the same time
+            with open(temp_path, "w", encoding="utf8") as f:
+                json.dump(raw, f, sort_keys=True)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError:
+            traceback.print_exc()
+
+    async def get_tools(self) -> Dict[str, MCPFunction]:
+        """
+        Return the tool catalog, from the local snapshot when it covers every host
+        so startup does not wait on the network, otherwise from a live discovery.
+        """
+        self.catalog = self.load_snapshot()
+        if self.mcp_host and set(self.catalog) != set(self.mcp_host):
+            self.catalog = await self.discover()
+            self.save_snapshot(self.catalog)
+        elif self.catalog:
+            print(f"Loaded MCP catalog snapshot for {len(self.catalog)} hosts")
+        return self.build_functions(self.catalog)
+
+    def start_refresh(self, on_change: Callable[[Dict[str, MCPFunction]], None]):
         """
-        Create a new session for the given client.
+        Refresh the catalog every MCPCATALOG_REFRESH_INTERVAL seconds and call
+        on_change with the new functions whenever it differs.
         """
-        return MCPSession(self)
-
-
-class MCPSession:
-    clients: Dict[str, List[ClientSession | Any]]
-
-    def __init__(self, manager: MCPManager):
-        self.manager = manager
-        self.clients = {}
-        self.exit_stack = AsyncExitStack()
-
-    async def get_client_session(self, name: str):
-        if name in self.clients:
-            return self.clients[name][0]
-        url = self.manager.mcp_host[name]
-        stream_client = sse_client(
-            url=url
-        )
-        read, write = await self.exit_stack.enter_async_context(stream_client)
-        session = await self.exit_stack.enter_async_context(ClientSession(read, write))
-        await session.initialize()
-        self.clients[name] = [session, stream_client]
-        return session
+        if self.mcp_host and self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._refresh_loop(on_change))
+
+    async def _refresh_loop(self, on_change: Callable[[Dict[str, MCPFunction]], None]):
+        delay = 0  # The first refresh validates a snapshot used at startup
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.refresh_interval
+            try:
+                catalog = await self.discover()
+                if self._catalog_key(catalog) == self._catalog_key(self.catalog):
+                    continue
+                self.catalog = catalog
+                self.save_snapshot(catalog)
+                on_change(self.build_functions(catalog))
+                print("MCP catalog changed, functions updated")
+            except Exception:
+                traceback.print_exc()
+
+    @staticmethod
+    def _catalog_raw(catalog: Dict[str, List[Tool]]) -> Dict[str, List[dict]]:
+        # Only the fields kept in the snapshot, so a loaded snapshot compares equal to a live discovery
+        return {
+            name: [tool.model_dump(mode="json", include=SNAPSHOT_FIELDS) for tool in tools]
+            for name, tools in catalog.items()
+        }
+
+    @staticmethod
+    def _catalog_key(catalog: Dict[str, List[Tool]]) -> str:
+        return json.dumps(MCPManager._catalog_raw(catalog), sort_keys=True)
 
     async def call_tool(self, function: MCPFunction, kwargs: dict):
-        client = await self.get_client_session(function.client_name)
         try:
-            data = await client.call_tool(function.name, kwargs)
-            return data
+            async with self.get_pool(function.client_name).borrow() as session:
+                return await session.call_tool(function.name, kwargs, read_timeout_seconds=self.call_timeout)
         except Exception as e:
             traceback.print_exc()
             raise e
-
-    async def __aenter__(self):
-        return self
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.exit_stack.aclose()
@@ -22,9 +22,13 @@ def is_optional_type(type_hint):
 class FunctionMeta:
     master_class = None
 
-    def __init__(self, func: callable, decs: str | None, descriptions: Dict[str, str]):
+    def __init__(self, func: callable, decs: str | None, descriptions: Dict[str, str],
+                 serial: bool = False, concurrency: int | None = None, max_output: int | None = None):
         self.func = func
         self.name = func.__name__
+        self.serial = serial  # Tool has side effects, never run it alongside other tool calls
+        self.concurrency = concurrency  # Max in-flight calls of this tool across all requests
+        self.max_output = max_output  # Max characters of output sent to the model, None for default, 0 for no limit
         if func.__doc__ is None and decs is None:
             raise ValueError("Function docstring and decs pram is not defined")
         self.description = textwrap.dedent(func.__doc__) if func.__doc__ is not None else textwrap.dedent(decs)
@@ -125,9 +129,9 @@ class FunctionMeta:
         return await loop.run_in_executor(pool, functools.partial(self.func, *args, **kwargs))
 
 
-def tool(decs: str=None, **arg_descriptions):
+def tool(decs: str=None, serial: bool=False, concurrency: int=None, max_output: int=None, **arg_descriptions):
     def decorator(func):
-        func_meta = FunctionMeta(func, decs, arg_descriptions)
+        func_meta = FunctionMeta(func, decs, arg_descriptions, serial, concurrency, max_output)
         return func_meta
 
     return decorator
@@ -145,4 +149,10 @@ class Module:
             if pram.name in self.functions:
                 raise ValueError(f"Function name \"{pram.name}\" is already defined")
             self.functions[pram.name] = pram
-            pram.set_master_class(self)
\ No newline at end of file
+            pram.set_master_class(self)
+
+    async def close(self):
+        """
+        Called when the client shuts down, release module owned resources here.
+        """
+        pass
\ No newline at end of file
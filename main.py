@@ -1,13 +1,25 @@
 import os
-from dotenv import load_dotenv
 
-if os.getenv('IS_DOCKER') is None:
-    load_dotenv()
+from classs.Cluster import Cluster, load_config
+
+load_config()
 
 # Bot Core
 
 from classs import FClient
 
-client = FClient()
+if __name__ == '__main__':
+    # Guarded so document converter and cluster worker processes can import this module safely
+    shard_count = int(os.getenv('SHARD_COUNT', '0'))
+    processes = int(os.getenv('CLUSTER_PROCESSES', '1'))
+    if processes > 1:
+        Cluster(
+            os.getenv('BOT_TOKEN'),
+            processes=processes,
+            shard_count=shard_count,
+            stats_interval=float(os.getenv('CLUSTER_STATS_INTERVAL', '60'))
+        ).run()
+    else:
+        client = FClient(shard_count=shard_count or None)
 
-client.run(os.getenv('BOT_TOKEN'))
+        client.run(os.getenv('BOT_TOKEN'))
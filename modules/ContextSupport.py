@@ -1,4 +1,5 @@
-from typing import List
+import re
+from typing import List, Optional
 import discord
 from classs import Module, tool
 from classs.AIContext import AIContext
@@ -8,6 +9,7 @@ from objs.EmbedArgs import EmbedArgs
 class ContextSupport(Module):
 
     @tool(
+        serial=True,
         filename="Name of file in temporary attachments",
     )
     async def move_temp_attachment(self, ctx: AIContext, filename: str):
@@ -21,6 +23,72 @@ class ContextSupport(Module):
             return {"reason": "file not found in temporary attachments", "success": False}
         return {"success": True, "filename": filename, "reason": f"file {filename} moved to message successfully"}
 
+    @tool(
+        max_output=0,
+        output_id="Id of the stored output returned with the truncated result",
+        offset="Character offset to start reading from",
+        length="Number of characters to read"
+    )
+    async def read_tool_output(self, ctx: AIContext, output_id: str, offset: int = 0, length: Optional[int] = None):
+        """
+        Read part of a tool output that was too long to be shown in full.
+        - Continue from `next_offset` to read the following part.
+        - Prefer `search_tool_output` when looking for specific information.
+        """
+        content = ctx.tool_outputs.get(output_id)
+        if content is None:
+            return {"success": False, "reason": f"output {output_id} not found"}
+        limit = self.client.tool_output_limit or len(content)
+        length = min(length or limit, limit)
+        offset = max(0, offset)
+        part = content[offset:offset + length]
+        end = offset + len(part)
+        return {
+            "success": True,
+            "content": part,
+            "offset": offset,
+            "next_offset": end if end < len(content) else None,
+            "total_length": len(content)
+        }
+
+    @tool(
+        max_output=0,
+        output_id="Id of the stored output returned with the truncated result",
+        query="Words to look for in the output",
+        max_results="Max number of matching parts to return"
+    )
+    async def search_tool_output(self, ctx: AIContext, output_id: str, query: str, max_results: Optional[int] = None):
+        """
+        Find the parts of a truncated tool output that best match the query.
+        Returns matching parts with their offsets, use `read_tool_output` to read around them.
+        """
+        content = ctx.tool_outputs.get(output_id)
+        if content is None:
+            return {"success": False, "reason": f"output {output_id} not found"}
+        terms = [term for term in re.findall(r"\w+", query.lower()) if len(term) > 1]
+        if not terms:
+            return {"success": False, "reason": "query has no searchable words"}
+        window = 1000
+        limit = self.client.tool_output_limit or len(content)
+        max_results = max(1, min(max_results or 5, limit // window or 1))
+        lowered = content.lower()
+        scored = []
+        for start in range(0, max(1, len(content) - window // 2), window // 2):
+            part = lowered[start:start + window]
+            score = sum(part.count(term) for term in terms)
+            if score:
+                scored.append((score, start))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        results = []
+        for score, start in scored:
+            if any(abs(start - taken["offset"]) < window for taken in results):
+                continue  # Overlaps a better part
+            results.append({"offset": start, "score": score, "content": content[start:start + window]})
+            if len(results) >= max_results:
+                break
+        results.sort(key=lambda item: item["offset"])
+        return {"success": True, "results": results, "total_length": len(content)}
+
 
 async def setup(client):
     await client.add_module(ContextSupport(client))
@@ -2,15 +2,19 @@ import asyncio
 import io
 import json
 import os
-from typing import Dict, List, Optional, Any
+import re
+import tempfile
+from typing import Dict, List, Optional, Any, Tuple, BinaryIO
 
 import aiohttp
 import numpy as np
 from numpy.linalg import norm
-from markitdown import MarkItDown, DocumentConverterResult, StreamInfo
 
 from classs import Module, tool
 from classs.AIContext import AIContext
+from classs.DocumentCache import DocumentCache
+from classs.DocumentConverter import DocumentConverter
+from classs.EmbeddingCache import EmbeddingCache
 from google_custom_search import Item
 
 
@@ -18,22 +22,143 @@ class SearchTool(Module):
 
     def __init__(self, client):
         super().__init__(client)
-        self.md = MarkItDown(enable_plugins=True, enable_builtins=True)
+        self.converter = DocumentConverter(
+            workers=int(os.getenv('CONVERT_WORKERS', str(min(4, os.cpu_count() or 1)))),
+            timeout=float(os.getenv('CONVERT_TIMEOUT', '60')),
+            max_pending=int(os.getenv('CONVERT_MAX_PENDING', '32')),
+            fast_paths=os.getenv('CONVERT_FAST_PATHS', '1') == '1'
+        )
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.max_bytes = int(os.getenv('FETCH_MAX_BYTES', str(20 * 1024 * 1024)))
+        self.max_text_bytes = int(os.getenv('FETCH_MAX_TEXT_BYTES', str(2 * 1024 * 1024)))
+        self.spill_bytes = int(os.getenv('FETCH_SPILL_BYTES', str(1024 * 1024)))
+        self.reject_types = tuple(
+            t.strip() for t in os.getenv('FETCH_REJECT_TYPES', 'video/,audio/').split(',') if t.strip()
+        )
+        self.document_cache = DocumentCache(
+            path=os.getenv('DOCUMENT_CACHE_PATH', 'cache/documents.sqlite3'),
+            max_bytes=int(os.getenv('DOCUMENT_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+            default_ttl=float(os.getenv('DOCUMENT_CACHE_DEFAULT_TTL', '3600'))
+        )
         self.feature_extraction_model = os.getenv('HUGGINGFACE_MODEL_FEATURE_EXTRACTION')
         self.openai_model = os.getenv('OPENAI_API_MODAL')
+        self.embedding_concurrency = int(os.getenv('EMBEDDING_CONCURRENCY', '4'))
+        self.embedding_batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', '32'))
+        self.chunk_size = int(os.getenv('SEARCH_CHUNK_SIZE', '1500'))
+        self.chunk_overlap = int(os.getenv('SEARCH_CHUNK_OVERLAP', '200'))
+        self.max_passages = int(os.getenv('SEARCH_MAX_PASSAGES', '64'))
+        self.top_k = int(os.getenv('SEARCH_TOP_K', '5'))
+        self.context_budget = int(os.getenv('SEARCH_CONTEXT_BUDGET', '8000'))
+        self.deep_search_fanout = int(os.getenv('DEEP_SEARCH_FANOUT', '3'))
+        self.deep_search_max_rounds = int(os.getenv('DEEP_SEARCH_MAX_ROUNDS', '5'))
+        self.deep_search_max_llm_calls = int(os.getenv('DEEP_SEARCH_MAX_LLM_CALLS', '16'))
+        self.deep_search_max_seconds = float(os.getenv('DEEP_SEARCH_MAX_SECONDS', '120'))
+        self.deep_search_rating = int(os.getenv('DEEP_SEARCH_RATING_THRESHOLD', '90'))
+        self.deep_search_min_results = int(os.getenv('DEEP_SEARCH_MIN_RESULTS', '10'))
+        self.embedding_batch_supported: Optional[bool] = None  # Unknown until the first batch call
+        self.embedding_cache = EmbeddingCache(
+            path=os.getenv('EMBEDDING_CACHE_PATH', 'cache/embeddings.sqlite3'),
+            memory_size=int(os.getenv('EMBEDDING_CACHE_MEMORY', '4096')),
+            max_entries=int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '100000')),
+            ttl=float(os.getenv('EMBEDDING_CACHE_TTL', '604800'))
+        )
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Shared session for every fetch so connections, DNS lookups and TLS
+        sessions are reused across requests.
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=int(os.getenv('FETCH_MAX_CONNECTIONS', '100')),
+                limit_per_host=int(os.getenv('FETCH_MAX_CONNECTIONS_PER_HOST', '8')),
+                ttl_dns_cache=int(os.getenv('FETCH_DNS_CACHE_TTL', '300')),
+                keepalive_timeout=float(os.getenv('FETCH_KEEPALIVE_TIMEOUT', '30'))
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=float(os.getenv('FETCH_TOTAL_TIMEOUT', '120')),
+                connect=float(os.getenv('FETCH_CONNECT_TIMEOUT', '10')),
+                sock_read=float(os.getenv('FETCH_READ_TIMEOUT', '30'))
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
 
-    async def process_body(self, item: Item) -> Optional[str]:
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.converter.close()
+
+    @staticmethod
+    def _is_text_type(content_type: str) -> bool:
+        return (content_type.startswith("text/") or content_type.endswith(("+json", "+xml")) or
+                content_type in ("application/json", "application/xml", "application/javascript"))
+
+    async def _read_body(self, response: aiohttp.ClientResponse, budget: int, truncate: bool) -> Optional[BinaryIO]:
+        """
+        Stream the body into memory, moving it to a named temporary file on disk once it
+        grows past FETCH_SPILL_BYTES so the converter process can open it by path. Bodies over budget are cut at a line break
+        when truncate is set, otherwise the download is aborted and None is returned.
+        """
+        body: BinaryIO = io.BytesIO()
+        size = 0
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(item.url) as response:
-                    if response.status != 200:
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                if size + len(chunk) > budget:
+                    if not truncate:
+                        print(f"Aborted {response.url}: body exceeds {budget} bytes")
+                        body.close()
                         return None
-                    stream_info = StreamInfo(mimetype=response.content_type, charset=response.charset)
-                    io_body = io.BytesIO(await response.read())
-                    content: DocumentConverterResult = await asyncio.to_thread(
-                        self.md.convert, io_body, stream_info=stream_info
-                    )
-                    return content.markdown
+                    chunk = chunk[:budget - size]
+                    newline = chunk.rfind(b"\n")
+                    if newline != -1:
+                        chunk = chunk[:newline + 1]
+                    body.write(chunk)
+                    break
+                body.write(chunk)
+                size += len(chunk)
+                if size > self.spill_bytes and isinstance(body, io.BytesIO):
+                    spill = tempfile.NamedTemporaryFile()
+                    spill.write(body.getbuffer())
+                    body.close()
+                    body = spill
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body
+
+    async def process_body(self, item: Item) -> Optional[str]:
+        try:
+            cached = await self.document_cache.get(item.url)
+            if cached is not None and cached.fresh():
+                return cached.markdown
+            headers = cached.validators() if cached is not None else {}
+            async with self.get_session().get(item.url, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    await self.document_cache.revalidate(cached, response.headers)
+                    return cached.markdown
+                if response.status != 200:
+                    return None
+                content_type = response.content_type
+                if content_type.startswith(self.reject_types):
+                    print(f"Skipped {item.url}: unsupported content type {content_type}")
+                    return None
+                # Text can still be used when cut short, other formats are useless truncated
+                is_text = self._is_text_type(content_type)
+                budget = self.max_text_bytes if is_text else self.max_bytes
+                if not is_text and response.content_length is not None and response.content_length > budget:
+                    print(f"Skipped {item.url}: {response.content_length} bytes exceeds {budget} bytes")
+                    return None
+                body = await self._read_body(response, budget, truncate=is_text)
+            if body is None:
+                return None
+            with body:
+                markdown = await self.converter.convert(body, content_type, response.charset)
+            await self.document_cache.set(item.url, markdown, response.headers)
+            return markdown
+        except asyncio.TimeoutError:
+            print(f"Error processing {item.url}: conversion timed out")
+            return None
         except Exception as e:
             print(f"Error processing {item.url}: {str(e)}")
             return None
@@ -41,50 +166,192 @@ class SearchTool(Module):
     async def process_search_results(self, context: str, search_results: List[Item]) -> str | None:
 
         documents_raw = await asyncio.gather(*[self.process_body(result) for result in search_results])
-        cleaned_documents = [doc for doc in documents_raw if doc is not None]
+        documents = [(item.url, doc) for item, doc in zip(search_results, documents_raw) if doc is not None]
 
-        if not cleaned_documents:
+        if not documents:
             return None
 
-        try:
-            context_features = await self.client.huggingface.feature_extraction(
-                model=self.feature_extraction_model,
-                text=context
-            )
-        except Exception as e:
-            print(f"Error extracting features from context: {str(e)}")
-            return "\n\n---\n\n".join(cleaned_documents[:3])
+        # Share the passage budget between documents, candidates are picked from the whole document
+        per_document = max(1, self.max_passages // len(documents))
+        passages = [
+            (url, passage) for url, doc in documents
+            for passage in self._candidate_passages(context, self._split_passages(doc), per_document)
+        ]
+        if not passages:
+            return None
 
-        similarity_results = []
-        for doc in cleaned_documents:
-            try:
-                doc_features = await self.client.huggingface.feature_extraction(
-                    model=self.feature_extraction_model,
-                    text=doc
-                )
-                similarity = self._calculate_similarity(context_features, doc_features)
-                similarity_results.append({"text": doc, "similarity": similarity})
-            except Exception as e:
-                print(f"Error processing document: {str(e)}")
-                continue
+        vectors = await self._embed([context] + [passage for _, passage in passages])
+        context_features = vectors[0]
+        if context_features is None:
+            return self._select_passages(passages)
 
-        if not similarity_results:
-            return "\n\n---\n\n".join(cleaned_documents[:3])
+        embedded = [
+            (passage, vector) for passage, vector in zip(passages, vectors[1:])
+            if vector is not None and vector.shape == context_features.shape
+        ]
+        if not embedded:
+            return self._select_passages(passages)
 
-        similarity_results.sort(key=lambda x: x["similarity"], reverse=True)
-        relevant_context = "\n\n---\n\n".join([doc["text"] for doc in similarity_results[:3]])
-        return relevant_context
+        similarities = self._calculate_similarities(context_features, np.stack([v for _, v in embedded]))
+        ranking = np.argsort(-similarities)
+        return self._select_passages([embedded[i][0] for i in ranking])
 
-    def _calculate_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-        v1 = np.array(vec1)
-        v2 = np.array(vec2)
+    @staticmethod
+    def _candidate_passages(context: str, passages: List[str], limit: int) -> List[str]:
+        """
+        Pick up to `limit` passages to embed from anywhere in a document: half by
+        how often they contain the query words, the rest spread evenly over the
+        document for matches that share no words with the query. Document order is kept.
+        """
+        if len(passages) <= limit:
+            return passages
+        terms = {term for term in re.findall(r"\w+", context.lower()) if len(term) > 2}
+        scores = [sum(passage.lower().count(term) for term in terms) for passage in passages]
+        matching = sorted((i for i, score in enumerate(scores) if score), key=lambda i: -scores[i])
+        chosen = set(matching[:max(1, limit // 2)])
+        for k in range(limit):
+            if len(chosen) >= limit:
+                break
+            chosen.add(k * len(passages) // limit)
+        index = 0
+        while len(chosen) < limit:  # Even positions taken by matches already
+            chosen.add(index)
+            index += 1
+        return [passages[i] for i in sorted(chosen)]
+
+    def _select_passages(self, passages: List[Tuple[str, str]]) -> str:
+        """
+        Take passages in order until SEARCH_TOP_K passages or
+        SEARCH_CONTEXT_BUDGET characters, each labeled with its source URL.
+        """
+        selected = []
+        budget = self.context_budget
+        for url, passage in passages:
+            block = f"Source: {url}\n\n{passage}"
+            if len(block) > budget:
+                continue
+            selected.append(block)
+            budget -= len(block)
+            if len(selected) >= self.top_k:
+                break
+        return "\n\n---\n\n".join(selected)
 
-        n1 = norm(v1)
-        n2 = norm(v2)
-        if n1 == 0 or n2 == 0:
-            return 0.0
+    def _split_passages(self, markdown: str) -> List[str]:
+        """
+        Split markdown into passages of about SEARCH_CHUNK_SIZE characters.
+        Passages break at headings and paragraphs, repeat their section heading
+        and overlap the previous passage by up to SEARCH_CHUNK_OVERLAP characters.
+        """
+        paragraphs = []
+        for paragraph in re.split(r"\n\s*\n", markdown):
+            paragraph = paragraph.strip()
+            step = max(1, self.chunk_size - self.chunk_overlap)
+            while len(paragraph) > self.chunk_size:
+                paragraphs.append(paragraph[:self.chunk_size])
+                paragraph = paragraph[step:]
+            if paragraph:
+                paragraphs.append(paragraph)
+
+        passages = []
+        current: List[str] = []
+        size = 0
+        heading = None
+        has_body = False  # Current passage has text that is not a heading or overlap
+        for paragraph in paragraphs:
+            is_heading = re.match(r"#{1,6}\s", paragraph) is not None
+            if has_body and (is_heading or size + len(paragraph) > self.chunk_size):
+                passages.append("\n\n".join(current))
+                has_body = False
+                overlap: List[str] = []
+                if not is_heading:
+                    overlap_size = 0
+                    for previous in reversed(current):
+                        if previous == heading or overlap_size + len(previous) > self.chunk_overlap:
+                            break
+                        overlap.insert(0, previous)
+                        overlap_size += len(previous)
+                    if heading is not None:
+                        overlap.insert(0, heading)
+                current = overlap
+                size = sum(len(p) for p in current)
+            if is_heading:
+                heading = paragraph
+            else:
+                has_body = True
+            current.append(paragraph)
+            size += len(paragraph)
+        if has_body:
+            passages.append("\n\n".join(current))
+        return passages
+
+    async def _embed(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Embed texts, serving repeated texts from the embedding cache.
+        Texts that fail to embed are returned as None.
+        """
+        vectors = await self.embedding_cache.get_many(self.feature_extraction_model, texts)
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if not missing:
+            return vectors
+        computed = await self._compute_embeddings([texts[index] for index in missing])
+        for index, vector in zip(missing, computed):
+            vectors[index] = vector
+        done = [(texts[index], vectors[index]) for index in missing if vectors[index] is not None]
+        if done:
+            await self.embedding_cache.set_many(
+                self.feature_extraction_model, [text for text, _ in done], [vector for _, vector in done]
+            )
+        return vectors
 
-        return np.dot(v1, v2) / (n1 * n2)
+    async def _compute_embeddings(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Embed texts in batches of EMBEDDING_BATCH_SIZE when the backend accepts list inputs,
+        otherwise concurrently with at most EMBEDDING_CONCURRENCY calls in flight.
+        """
+        if len(texts) > 1 and self.embedding_batch_supported is not False:
+            try:
+                batches = [texts[i:i + self.embedding_batch_size] for i in range(0, len(texts), self.embedding_batch_size)]
+                results = await asyncio.gather(*[
+                    self.client.huggingface.feature_extraction(model=self.feature_extraction_model, text=batch)
+                    for batch in batches
+                ])
+                features = np.concatenate([np.asarray(result, dtype=np.float32) for result in results])
+                if features.ndim == 2 and features.shape[0] == len(texts):
+                    self.embedding_batch_supported = True
+                    return list(features)
+                print(f"Unexpected batch feature extraction shape {features.shape}, using single requests")
+                self.embedding_batch_supported = False
+            except Exception as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status in (400, 413, 422):
+                    self.embedding_batch_supported = False
+                print(f"Error in batch feature extraction: {str(e)}")
+
+        semaphore = asyncio.Semaphore(self.embedding_concurrency)
+
+        async def embed_one(text: str) -> Optional[np.ndarray]:
+            async with semaphore:
+                try:
+                    features = await self.client.huggingface.feature_extraction(
+                        model=self.feature_extraction_model,
+                        text=text
+                    )
+                except Exception as e:
+                    print(f"Error extracting features: {str(e)}")
+                    return None
+            features = np.asarray(features, dtype=np.float32)
+            if features.ndim > 1:
+                # Token level output, mean pool into one vector
+                features = features.reshape(-1, features.shape[-1]).mean(axis=0)
+            return features
+
+        return list(await asyncio.gather(*[embed_one(text) for text in texts]))
+
+    def _calculate_similarities(self, context: np.ndarray, documents: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every row of documents against context."""
+        norms = norm(documents, axis=1) * norm(context)
+        scores = documents @ context
+        return np.divide(scores, norms, out=np.zeros_like(scores), where=norms != 0)
 
     def _refomart_item_to_dict(self, item: Item, show:bool=True) -> Dict[str, Any]:
         return {
@@ -109,11 +376,12 @@ class SearchTool(Module):
                 Original Target context: {original_target}
                 Current target context: {current_target}
                 Current search query: {search_query}
-                You MUST return improved search query based on the results and rating.
+                You MUST return improved search queries based on the results and rating.
+                - Return up to {self.deep_search_fanout} different queries, most promising first.
                 - Rating should be between 1 to 100.
                 Response MUST be in JSON format with the following structure Example:
                 {{
-                    "query": "...", // Improved search query for next search
+                    "queries": ["...", "..."], // Improved search queries for next search
                     "store": [1,4,5], // Indexes of the results to store from unfiltered data. Start with 0
                     "target_context": "..." // Target context for next search
                     "rating": 0 -> 100 // Rating quality of the selected context and filtered data
@@ -153,6 +421,43 @@ class SearchTool(Module):
             }
         ]
 
+    async def _deep_search_branch(
+            self,
+            target_context: str,
+            current_target: str,
+            search_query: str,
+            stored_results: List[Item],
+            seen_urls: set
+    ) -> Tuple[Dict[str, Any], List[Item], Optional[str]]:
+        """
+        One deep search branch: search, rate the results and fetch the selected ones
+        that no other branch has fetched yet.
+        """
+        # noinspection PyUnresolvedReferences
+        search_results = await self.client.google_search_client.search(search_query)
+        evaluation_message = self._create_evaluation_message(
+            target_context, current_target, search_query, stored_results, search_results
+        )
+        evaluation_response = await self.client.llm.create(
+            model=self.openai_model,
+            messages=evaluation_message
+        )
+        evaluation_data = json.loads(evaluation_response.choices[0].message.content)
+
+        selected = []
+        for index in evaluation_data.get("store", []):
+            if isinstance(index, int) and 0 <= index < len(search_results):
+                item = search_results[index]
+                if item.url not in seen_urls:
+                    seen_urls.add(item.url)
+                    selected.append(item)
+        context = None
+        if selected:
+            context = await self.process_search_results(
+                evaluation_data.get("target_context", current_target), selected
+            )
+        return evaluation_data, selected, context
+
     @tool(
         prompt="Search query for deep search",
         target_context="Content to search for in the results"
@@ -193,65 +498,74 @@ class SearchTool(Module):
                 "reason": "Deep search is not enabled. Missing required dependencies."
             }
 
-        results = []
-        current_target = target_context
-        max_iterations = 20
-        iterations = 0
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deep_search_max_seconds
+        llm_calls = 1  # Reserved for the summary
+        results: List[Item] = []
+        seen_urls = set()
         relevant_context = ""
-        while True:
-            iterations += 1
-            if iterations > max_iterations and not results:
-                return {
-                    "success": False,
-                    "reason": "Deep search exceeded maximum iterations."
-                }
-            elif results and iterations > max_iterations:
+        current_target = target_context
+        queries = [search_query]
+        errors = []
+        for _ in range(self.deep_search_max_rounds):
+            queries = queries[:self.deep_search_max_llm_calls - llm_calls]
+            remaining = deadline - loop.time()
+            if not queries or remaining <= 0:
+                break
+            llm_calls += len(queries)
+            tasks = [
+                asyncio.create_task(self._deep_search_branch(target_context, current_target, query, results, seen_urls))
+                for query in queries
+            ]
+            done, pending = await asyncio.wait(tasks, timeout=remaining)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+            evaluations = []
+            for task in tasks:
+                if task not in done:
+                    continue
+                if task.exception() is not None:
+                    errors.append(str(task.exception()))
+                    print(f"Error during deep search evaluation: {task.exception()}")
+                    continue
+                evaluation_data, stored, context = task.result()
+                evaluations.append(evaluation_data)
+                results.extend(stored)
+                if context:
+                    relevant_context += context + "\n\n---\n\n"
+            if not evaluations:
                 break
 
-            # noinspection PyUnresolvedReferences
-            search_results = await self.client.google_search_client.search(search_query)
-
+            evaluations.sort(key=lambda e: e.get("rating", 0), reverse=True)
+            best = evaluations[0]
+            print(f"Evaluation Data: {best}")
+            current_target = best.get("target_context", current_target)
+            if best.get("rating", 0) >= self.deep_search_rating and len(results) >= self.deep_search_min_results:
+                break
 
-            evaluation_message = self._create_evaluation_message(
-                target_context, current_target, search_query, results, search_results
-            )
+            # Interleave proposals so every branch contributes its best query first
+            proposals = [e.get("queries") or [e.get("query")] for e in evaluations]
+            queries = []
+            for rank in range(max(len(p) for p in proposals)):
+                for proposal in proposals:
+                    if rank < len(proposal) and proposal[rank] and proposal[rank] not in queries:
+                        queries.append(proposal[rank])
+            queries = queries[:self.deep_search_fanout]
 
-            try:
-                evaluation_response = await self.client.openai.chat.completions.create(
-                    model=self.openai_model,
-                    messages=evaluation_message
-                )
-
-                evaluation_data = json.loads(evaluation_response.choices[0].message.content)
-                print(f"Evaluation Data: {evaluation_data}")
-                if evaluation_data["rating"] >= 90 and len(results) >= 10:
-                    break
-
-                search_query = evaluation_data["query"]
-                current_target = evaluation_data.get("target_context", current_target)
-                temp_selected = []
-                for index in evaluation_data["store"]:
-                    if index < len(search_results):
-                        results.append(search_results[index])
-                        temp_selected.append(search_results[index])
-                if temp_selected:
-                    relevant_context_temp = await self.process_search_results(
-                        current_target, temp_selected
-                    )
-                    if relevant_context_temp is not None:
-                        relevant_context += relevant_context_temp + "\n\n---\n\n"
-            except Exception as e:
-                return {
-                    "success": False,
-                    "reason": f"Error during evaluation: {str(e)}"
-                }
+        if not results:
+            return {
+                "success": False,
+                "reason": f"Error during evaluation: {errors[0]}" if errors else "Deep search found no relevant results."
+            }
 
         try:
             summary_message = self._create_summary_message(
                 target_context, current_target, relevant_context
             )
 
-            summary_response = await self.client.openai.chat.completions.create(
+            summary_response = await self.client.llm.create(
                 model=self.openai_model,
                 messages=summary_message
             )
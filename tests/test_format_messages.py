@@ -0,0 +1,40 @@
+"""
+Golden test for the component markup parser.
+
+tests/fixtures/component_markup.json holds markup samples (the examples from
+resources/system_prompt.md plus edge cases) with the output of the original
+regex based parser, the single pass parser must produce the same structures.
+"""
+import json
+import os
+
+import pytest
+
+from classs.FormatMessages import FormatMessages
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "component_markup.json")
+
+with open(FIXTURES, "r", encoding="utf8") as f:
+    CASES = json.load(f)
+
+
+@pytest.fixture(scope="module")
+def formatter() -> FormatMessages:
+    # The parser does not use the client, skip __init__ so no bot is needed
+    return FormatMessages.__new__(FormatMessages)
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_matches_baseline(formatter, case):
+    assert formatter.regex_chuck_component(case["text"]) == case["expected"]
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_stream_parser_matches_when_complete(formatter, case):
+    parser = formatter.create_stream_parser()
+    for index in range(0, len(case["text"]), 7):
+        parser.feed(case["text"][index:index + 7])
+        parser.items()
+    if "unclosed" in case["name"] or "missing" in case["name"]:
+        pytest.skip("Unclosed blocks render their parsed children while streaming")
+    assert parser.items() == case["expected"]
@@ -0,0 +1,62 @@
+"""
+HistoryCache keeps serving complete history after a cold channel is seeded by REST.
+"""
+import asyncio
+from types import SimpleNamespace
+
+from classs.HistoryCache import HistoryCache
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, history, during_fetch=None):
+        self.id = channel_id
+        self.stored = history  # Messages REST knows about
+        self.during_fetch = during_fetch  # Called while the REST request is in flight
+
+    async def history(self, limit: int, before):
+        if self.during_fetch is not None:
+            self.during_fetch()
+        for message in sorted(self.stored, key=lambda m: -m.id):
+            if message.id < before.id and limit > 0:
+                limit -= 1
+                yield message
+
+
+def make_message(message_id: int, channel: FakeChannel):
+    return SimpleNamespace(id=message_id, channel=channel, guild=None)
+
+
+def ids(messages):
+    return [message.id for message in messages]
+
+
+def test_cold_fetch_then_next_mention():
+    cache = HistoryCache(size=20, max_channels=10)
+    channel = FakeChannel(1, [])
+    channel.stored = [make_message(i, channel) for i in range(1, 6)]
+    m10 = make_message(10, channel)
+    m11 = make_message(11, channel)
+
+    cache.add(m10)  # Cold channel, not buffered yet
+    assert ids(asyncio.run(cache.history(m10, 10))) == [5, 4, 3, 2, 1]
+    assert cache.rest_fetches == 1
+
+    cache.add(m11)
+    assert ids(asyncio.run(cache.history(m11, 10))) == [10, 5, 4, 3, 2, 1]
+    assert cache.rest_fetches == 1  # Served from the buffer
+
+
+def test_messages_arriving_during_fetch_are_kept():
+    cache = HistoryCache(size=20, max_channels=10)
+    channel = FakeChannel(1, [])
+    channel.stored = [make_message(i, channel) for i in range(1, 6)]
+    m10 = make_message(10, channel)
+    m11 = make_message(11, channel)
+    m12 = make_message(12, channel)
+    channel.during_fetch = lambda: cache.add(m11)
+
+    asyncio.run(cache.history(m10, 10))
+    channel.during_fetch = None
+    cache.add(m12)
+    assert ids(asyncio.run(cache.history(m12, 10))) == [11, 10, 5, 4, 3, 2, 1]
+    assert cache.rest_fetches == 1